@@ -1,40 +1,120 @@
 #!/usr/bin/env python3
 """Find and delete unreferenced sound files in mod/sounds/voice/"""
 
+import json
+import mmap
+import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import sys
 
+# Matches file paths in <Path name="..."> tags
+PATH_RE = re.compile(rb'<Path\s+name="data/sounds/voice/([^"]+)"')
+
+# Referenced paths per XML file, keyed by the file's mtime and size
+CACHE_PATH = Path(".cache/voice_refs.json")
+
+
+def scan_xml_file(xml_file):
+    """Get the voice file paths referenced in a single XML file"""
+    with open(xml_file, "rb") as f:
+        # Empty files can't be mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+
+        # Scan the mapped pages directly instead of reading into a copy
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return PATH_RE.findall(mm)
+
+
+def load_cache():
+    """Load the cached XML references, or an empty cache if there isn't one"""
+    try:
+        with open(CACHE_PATH, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_cache(cache):
+    """Write the XML references cache to disk"""
+    CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with open(CACHE_PATH, "w") as f:
+        json.dump(cache, f)
+
 
 def get_referenced_files():
     """Get all voice files referenced in XML files"""
     sounds_dir = Path("mod/sounds")
     xml_files = list(sounds_dir.glob("gfl_voice_lines_*.xml"))
 
-    referenced = set()
+    old_cache = load_cache()
+    cache = {}
+    to_scan = []
 
+    # Only rescan files that changed since the last run
     for xml_file in xml_files:
-        with open(xml_file, "r") as f:
-            content = f.read()
+        stat = xml_file.stat()
+        signature = [stat.st_mtime_ns, stat.st_size]
+        entry = old_cache.get(str(xml_file))
+
+        if entry and entry["signature"] == signature:
+            cache[str(xml_file)] = entry
+        else:
+            to_scan.append((xml_file, signature))
+
+    if to_scan:
+        # Reading is I/O bound, so scan the files concurrently
+        with ThreadPoolExecutor(max_workers=min(32, len(to_scan))) as executor:
+            results = executor.map(scan_xml_file, [xml_file for xml_file, _ in to_scan])
+            for (xml_file, signature), paths in zip(to_scan, results):
+                cache[str(xml_file)] = {
+                    "signature": signature,
+                    "paths": [path.decode() for path in paths],
+                }
+
+    if cache != old_cache:
+        save_cache(cache)
 
-        # Find all file paths in <Path name="..."> tags
-        paths = re.findall(r'<Path\s+name="data/sounds/voice/([^"]+)"', content)
-        referenced.update(paths)
+    referenced = set()
+    for entry in cache.values():
+        referenced.update(entry["paths"])
 
     return referenced
 
 
+def walk_wav_files(root):
+    """Yield paths of all .wav files under root, relative to root"""
+    stack = [root]
+    prefix_len = len(root) + 1
+
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".wav"):
+                    yield entry.path[prefix_len:]
+
+
 def get_all_voice_files():
     """Get all .wav files in mod/sounds/voice/"""
-    voice_dir = Path("mod/sounds/voice")
-    all_files = set()
+    voice_dir = "mod/sounds/voice"
+
+    if not os.path.isdir(voice_dir):
+        return set()
+
+    return set(walk_wav_files(voice_dir))
 
-    for wav_file in voice_dir.rglob("*.wav"):
-        # Get path relative to mod/sounds/voice/
-        rel_path = wav_file.relative_to(voice_dir)
-        all_files.add(str(rel_path))
 
-    return all_files
+def delete_file(path):
+    """Delete a file, returning its path or None if it was already gone"""
+    try:
+        os.unlink(path)
+        return path
+    except FileNotFoundError:
+        return None
 
 
 def main():
@@ -71,17 +151,13 @@ def main():
     response = input("\nDelete these files? (yes/no): ").strip().lower()
 
     if response == "yes":
-        voice_dir = Path("mod/sounds/voice")
-        deleted_count = 0
+        voice_dir = "mod/sounds/voice"
+        paths = [os.path.join(voice_dir, file_path) for file_path in unreferenced]
 
-        for file_path in unreferenced:
-            full_path = voice_dir / file_path
-            if full_path.exists():
-                full_path.unlink()
-                deleted_count += 1
-                print(f"Deleted: {file_path}")
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            deleted = [path for path in executor.map(delete_file, paths) if path]
 
-        print(f"\n✓ Deleted {deleted_count} unreferenced voice files")
+        print(f"\n✓ Deleted {len(deleted)} unreferenced voice files")
         return 0
     else:
         print("\nCancelled - no files were deleted")
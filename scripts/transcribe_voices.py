@@ -1,27 +1,136 @@
 #!/usr/bin/env python3
 """Transcribe and translate Japanese voice files to English"""
 
-import os
-import warnings
-import whisper
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import subprocess
 import sys
-import torch
 
-# Suppress specific ROCm warnings
-warnings.filterwarnings("ignore", message=".*hipBLASLt.*")
-warnings.filterwarnings("ignore", message=".*Flash attention.*")
-warnings.filterwarnings("ignore", message=".*Memory Efficient attention.*")
+import numpy as np
 
-# Enable experimental ROCm features for better performance on newer AMD GPUs
-os.environ.setdefault("TORCH_ROCM_AOTRITON_ENABLE_EXPERIMENTAL", "1")
+# ctranslate2 and faster_whisper are imported where they are used, as loading
+# them takes seconds and isn't needed for --help or when there's nothing to do
 
+# Number of clips stacked into a single encoder/decoder pass
+BATCH_SIZE = 16
 
-def transcribe_character_dir(character_dir, model, device):
+# Whisper works on 30 second windows of 16kHz audio
+WINDOW_SAMPLES = 30 * 16000
+
+Translation = namedtuple("Translation", "file translation")
+
+
+def fp16_is_beneficial():
+    """
+    Check whether the GPU runs FP16 faster than FP32.
+
+    Pascal and older NVIDIA cards have little or no FP16 throughput, so they
+    are better off with FP32 activations. CTranslate2 still lists FP16 types
+    for them, so the compute capability is read from nvidia-smi instead.
+    """
+    import ctranslate2
+
+    if not ctranslate2.get_cuda_device_count():
+        return False
+    if "int8_float16" not in ctranslate2.get_supported_compute_types("cuda"):
+        return False
+
+    try:
+        result = subprocess.run(
+            [
+                "nvidia-smi",
+                "--query-gpu=compute_cap",
+                "--format=csv,noheader",
+                "-i",
+                "0",
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        major, minor = result.stdout.strip().split(".")
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return False
+
+    return (int(major), int(minor)) >= (7, 0)
+
+
+def trim_to_speech(audio):
+    """
+    Cut a decoded clip down to its speech segments using Silero VAD.
+
+    Returns None when the clip has no speech, so silent and SFX-only files
+    can be skipped without running Whisper on them.
+    """
+    from faster_whisper.vad import get_speech_timestamps
+
+    speech = get_speech_timestamps(audio)
+
+    if not speech:
+        return None
+
+    return np.concatenate([audio[ts["start"] : ts["end"]] for ts in speech])
+
+
+def load_clip(audio_file):
+    """Decode a clip and trim it to speech, returning None if it has none."""
+    from faster_whisper import decode_audio
+
+    return trim_to_speech(decode_audio(str(audio_file)))
+
+
+def transcribe_batch(model, audios):
+    """
+    Translate a batch of decoded clips.
+
+    Clips that fit in a single Whisper window are padded, stacked and run
+    through one encoder/decoder pass, so short voice lines share a forward
+    pass instead of paying for one each. Longer clips fall back to
+    faster-whisper's own chunked transcription.
+    """
+    from faster_whisper.audio import pad_or_trim
+    from faster_whisper.tokenizer import Tokenizer
+
+    tokenizer = Tokenizer(
+        model.hf_tokenizer,
+        model.model.is_multilingual,
+        task="translate",
+        language="ja",
+    )
+    prompt = model.get_prompt(tokenizer, [], without_timestamps=True)
+
+    translations = {}
+    batched = []
+
+    for i, audio in enumerate(audios):
+        if len(audio) > WINDOW_SAMPLES:
+            # Already trimmed to speech by load_clip, so no vad_filter here
+            segments, _ = model.transcribe(
+                audio, language="ja", task="translate", beam_size=5
+            )
+            translations[i] = "".join(segment.text for segment in segments).strip()
+        else:
+            batched.append(i)
+
+    if batched:
+        features = np.stack(
+            [pad_or_trim(model.feature_extractor(audios[i])[..., :-1]) for i in batched]
+        )
+        results = model.model.generate(
+            model.encode(features), [prompt] * len(batched), beam_size=5
+        )
+        for i, result in zip(batched, results):
+            translations[i] = tokenizer.decode(result.sequences_ids[0]).strip()
+
+    return [translations[i] for i in range(len(audios))]
+
+
+def transcribe_character_dir(character_dir, model):
     """
     Transcribe all voice files in a character directory.
 
-    Returns a list of translation results.
+    Returns a list of Translation results.
     """
     # Find all audio files
     audio_extensions = {".wav", ".ogg", ".flac", ".mp3", ".m4a"}
@@ -37,26 +146,57 @@ def transcribe_character_dir(character_dir, model, device):
 
     results = []
 
-    for i, audio_file in enumerate(audio_files, 1):
-        print(f"  [{i}/{len(audio_files)}] {audio_file.name}")
-
-        try:
-            # Transcribe and translate to English
-            use_fp16 = device == "cuda"
-            result = model.transcribe(
-                str(audio_file), language="ja", task="translate", fp16=use_fp16
-            )
-
-            translation = result["text"].strip()
-
-            if translation:
-                results.append({"file": audio_file.name, "translation": translation})
-                print(f"    EN: {translation}")
-            else:
-                print("    (no speech detected)")
-
-        except Exception as e:
-            print(f"    Error: {e}")
+    batches = [
+        list(enumerate(audio_files[start : start + BATCH_SIZE], start + 1))
+        for start in range(0, len(audio_files), BATCH_SIZE)
+    ]
+
+    # Decode the next batch on the CPU while the current one is transcribed
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        pending = [executor.submit(load_clip, f) for _, f in batches[0]]
+
+        for b, batch_files in enumerate(batches):
+            futures = pending
+            if b + 1 < len(batches):
+                pending = [executor.submit(load_clip, f) for _, f in batches[b + 1]]
+
+            batch = []
+            audios = []
+
+            for (i, audio_file), future in zip(batch_files, futures):
+                try:
+                    audio = future.result()
+                except Exception as e:
+                    print(f"  [{i}/{len(audio_files)}] {audio_file.name}")
+                    print(f"    Error: {e}")
+                    continue
+
+                if audio is None:
+                    print(f"  [{i}/{len(audio_files)}] {audio_file.name}")
+                    print("    (no speech detected)")
+                    continue
+
+                audios.append(audio)
+                batch.append((i, audio_file))
+
+            if not audios:
+                continue
+
+            try:
+                # Transcribe and translate to English
+                translations = transcribe_batch(model, audios)
+            except Exception as e:
+                print(f"  [{batch[0][0]}-{batch[-1][0]}/{len(audio_files)}] Error: {e}")
+                continue
+
+            for (i, audio_file), translation in zip(batch, translations):
+                print(f"  [{i}/{len(audio_files)}] {audio_file.name}")
+
+                if translation:
+                    results.append(Translation(audio_file.name, translation))
+                    print(f"    EN: {translation}")
+                else:
+                    print("    (no speech detected)")
 
     return results
 
@@ -92,18 +232,34 @@ def process_voice_directories(voice_base_dir, model_name="large", force=False):
         print("Use --force to regenerate transcriptions.")
         return
 
-    # Initialize model once
-    device = "cuda" if torch.cuda.is_available() else "cpu"
+    import ctranslate2
+    from faster_whisper import WhisperModel
+
+    # Initialize model once. CTranslate2 runs the model, so the GPU has to be
+    # one its build can use, not just one torch can see
+    gpu_count = ctranslate2.get_cuda_device_count()
+    device = "cuda" if gpu_count else "cpu"
     print(f"\nUsing device: {device}")
     if device == "cuda":
-        print(f"GPU: {torch.cuda.get_device_name(0)}")
+        print(f"GPUs: {gpu_count}")
 
     print(f"\nLoading Whisper model: {model_name}")
     print("(First run will download the model)")
     print(
         "Model sizes: tiny (~75MB), base (~150MB), small (~500MB), medium (~1.5GB), large (~3GB)"
     )
-    model = whisper.load_model(model_name, device=device)
+    # int8 weights halve memory use and bandwidth with negligible accuracy loss,
+    # activations stay in FP32 unless the GPU supports FP16
+    if fp16_is_beneficial():
+        compute_type = "int8_float16"
+    elif "int8" in ctranslate2.get_supported_compute_types(device):
+        compute_type = "int8"
+    else:
+        compute_type = "float32"
+    print(f"Compute type: {compute_type}")
+    model = WhisperModel(
+        model_name, device=device, compute_type=compute_type, num_workers=1
+    )
 
     print(f"\n{'=' * 60}")
     print(f"Processing {len(dirs_to_process)} character(s)")
@@ -113,7 +269,7 @@ def process_voice_directories(voice_base_dir, model_name="large", force=False):
     for idx, char_dir in enumerate(dirs_to_process, 1):
         print(f"[{idx}/{len(dirs_to_process)}] Processing {char_dir.name}...")
 
-        results = transcribe_character_dir(char_dir, model, device)
+        results = transcribe_character_dir(char_dir, model)
 
         if results:
             # Write to _trans.txt in the character directory
@@ -121,14 +277,12 @@ def process_voice_directories(voice_base_dir, model_name="large", force=False):
 
             with open(output_file, "w", encoding="utf-8") as f:
                 f.write(f"# Voice Line Translations for {char_dir.name}\n")
-                f.write("# Generated automatically using OpenAI Whisper\n")
+                f.write("# Generated automatically using Whisper (faster-whisper)\n")
                 f.write(f"# Total files: {len(results)}\n")
                 f.write("\n")
 
                 for item in results:
-                    f.write(f"{item['file']}\n")
-                    f.write(f"  {item['translation']}\n")
-                    f.write("\n")
+                    f.write(f"{item.file}\n  {item.translation}\n\n")
 
             print(f"  ✓ Saved {len(results)} translations to {output_file}")
         else:
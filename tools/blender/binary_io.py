@@ -1,6 +1,6 @@
 import struct
 
-from bpy_extras.io_utils import axis_conversion
+import numpy as np
 from mathutils import Matrix, Quaternion, Vector
 
 KHM_VERSION = 101
@@ -8,127 +8,234 @@ KHM_MAX_OBJECT_NAME = 48
 KHM_MAX_BONE_INFLUENCES = 4
 KHM_MAX_BONES = 64
 
+# Pre-compiled formats so the helpers don't re-parse a format string per call
+_UCHAR = struct.Struct("<B")
+_UINT = struct.Struct("<I")
+_INT = struct.Struct("<i")
+_USHORT = struct.Struct("<H")
+_FLOAT = struct.Struct("<f")
+_VECTOR2 = struct.Struct("<2f")
+_VECTOR3 = struct.Struct("<3f")
+_VECTOR4 = struct.Struct("<4f")
+_MATRIX = struct.Struct("<16f")
+_BONE_INDICE = struct.Struct(f"<{KHM_MAX_BONE_INFLUENCES}B")
+
+# One animation keyframe as stored in the file: rotation quaternion (x, y, z,
+# w), translation and scale, in KHM axes
+NODE_TRANSFORM_DTYPE = np.dtype(
+    [("qRot", "<f4", 4), ("vTrans", "<f4", 3), ("vScale", "<f4", 3)]
+)
+
+# One convex collision polygon: plane normal, -d, and the polygon's run in
+# the collision mesh's index list
+COLLISION_POLYGON_DTYPE = np.dtype(
+    [("normal", "<f4", 3), ("d", "<f4"), ("numIndices", "<i2"), ("indexStart", "<i2")]
+)
+
+# Shared zero padding, sliced through a memoryview so writes don't allocate
+_ZEROS = memoryview(bytes(4096))
+
+
+class Cursor:
+    """Read position over an in-memory KHM file, used in place of a file object"""
+
+    __slots__ = ("buf", "offset")
+
+    def __init__(self, buf, offset=0):
+        self.buf = buf
+        self.offset = offset
+
+    def read(self, size):
+        offset = self.offset
+        self.offset = offset + size
+        return self.buf[offset : offset + size]
+
+    def tell(self):
+        return self.offset
+
 
 def ReadUChar(file):
-    return struct.unpack("B", file.read(1))[0]
+    value = _UCHAR.unpack_from(file.buf, file.offset)[0]
+    file.offset += 1
+    return value
 
 
 def WriteUChar(file, value):
-    file.write(struct.pack("B", value))
+    file.write(_UCHAR.pack(value))
 
 
 def ReadUInt(file):
-    return struct.unpack("I", file.read(4))[0]
+    value = _UINT.unpack_from(file.buf, file.offset)[0]
+    file.offset += 4
+    return value
 
 
 def WriteUInt(file, value):
-    file.write(struct.pack("I", value))
+    file.write(_UINT.pack(value))
 
 
 def ReadInt(file):
-    return struct.unpack("i", file.read(4))[0]
+    value = _INT.unpack_from(file.buf, file.offset)[0]
+    file.offset += 4
+    return value
 
 
 def WriteInt(file, value):
-    file.write(struct.pack("i", value))
+    file.write(_INT.pack(value))
 
 
 def ReadUShort(file):
-    return struct.unpack("H", file.read(2))[0]
+    value = _USHORT.unpack_from(file.buf, file.offset)[0]
+    file.offset += 2
+    return value
 
 
 def WriteUShort(file, value):
-    file.write(struct.pack("H", value))
+    file.write(_USHORT.pack(value))
 
 
 def ReadFloat(file):
-    return struct.unpack("f", file.read(4))[0]
+    value = _FLOAT.unpack_from(file.buf, file.offset)[0]
+    file.offset += 4
+    return value
 
 
 def WriteFloat(file, value):
-    file.write(struct.pack("f", value))
+    file.write(_FLOAT.pack(value))
+
+
+def _ReadArrayView(file, dtype, count):
+    # A view into the file buffer, only valid while the buffer is open
+    dtype = np.dtype(dtype)
+    value = np.frombuffer(file.buf, dtype=dtype, count=count, offset=file.offset)
+    file.offset += dtype.itemsize * count
+    return value
+
+
+# The array readers return copies, so nothing parsed out of a file keeps its
+# buffer (and with it the file mapping) alive
+
+
+def ReadFloatArray(file, count):
+    return _ReadArrayView(file, "<f4", count).copy()
+
+
+def ReadUCharArray(file, count):
+    return _ReadArrayView(file, np.uint8, count).copy()
+
+
+def ReadUShortArray(file, count):
+    return _ReadArrayView(file, "<u2", count).copy()
+
+
+def ReadSwizzledVector3Array(file, count):
+    value = _ReadArrayView(file, "<f4", 3 * count).reshape(-1, 3)[:, (0, 2, 1)]
+    value[:, 1] *= -1
+    return value
+
+
+def WriteFloatArray(file, value):
+    file.write(np.ascontiguousarray(value, dtype="<f4"))
+
+
+def WriteUCharArray(file, value):
+    file.write(np.ascontiguousarray(value, dtype=np.uint8))
+
+
+def WriteUShortArray(file, value):
+    value = np.asarray(value)
+    if value.size and (value.min() < 0 or value.max() > 0xFFFF):
+        raise struct.error("ushort format requires 0 <= number <= 65535")
+    file.write(np.ascontiguousarray(value, dtype="<u2"))
+
+
+def WriteSwizzledVector3Array(file, value):
+    value = np.asarray(value, dtype="<f4").reshape(-1, 3)[:, (0, 2, 1)]
+    value[:, 2] *= -1
+    file.write(np.ascontiguousarray(value))
+
+
+def ReadNodeTransformArray(file, count):
+    return _ReadArrayView(file, NODE_TRANSFORM_DTYPE, count).copy()
+
+
+def WriteNodeTransformArray(file, value):
+    file.write(np.ascontiguousarray(value, dtype=NODE_TRANSFORM_DTYPE))
+
+
+def ReadCollisionPolygonArray(file, count):
+    return _ReadArrayView(file, COLLISION_POLYGON_DTYPE, count).copy()
+
+
+def WriteCollisionPolygonArray(file, value):
+    file.write(np.ascontiguousarray(value, dtype=COLLISION_POLYGON_DTYPE))
 
 
 def ReadVector2(file):
-    return Vector((ReadFloat(file), ReadFloat(file)))
+    value = Vector(_VECTOR2.unpack_from(file.buf, file.offset))
+    file.offset += 8
+    return value
 
 
 def WriteVector2(file, value):
-    WriteFloat(file, value[0])
-    WriteFloat(file, value[1])
+    file.write(_VECTOR2.pack(value[0], value[1]))
 
 
 def ReadVector3(file):
-    return Vector((ReadFloat(file), ReadFloat(file), ReadFloat(file)))
+    value = Vector(_VECTOR3.unpack_from(file.buf, file.offset))
+    file.offset += 12
+    return value
 
 
 def ReadSwizzledVector3(file):
-    x = ReadFloat(file)
-    y = ReadFloat(file)
-    z = ReadFloat(file)
+    x, y, z = _VECTOR3.unpack_from(file.buf, file.offset)
+    file.offset += 12
     return Vector((x, -z, y))
 
 
 def WriteVector3(file, value):
-    WriteFloat(file, value[0])
-    WriteFloat(file, value[1])
-    WriteFloat(file, value[2])
+    file.write(_VECTOR3.pack(value[0], value[1], value[2]))
 
 
 def WriteSwizzledVector3(file, value):
-    WriteFloat(file, value[0])
-    WriteFloat(file, value[2])
-    WriteFloat(file, -value[1])
+    file.write(_VECTOR3.pack(value[0], value[2], -value[1]))
 
 
 def ReadVector4(file):
-    return Vector((ReadFloat(file), ReadFloat(file), ReadFloat(file), ReadFloat(file)))
+    value = Vector(_VECTOR4.unpack_from(file.buf, file.offset))
+    file.offset += 16
+    return value
 
 
 def WriteVector4(file, value):
-    WriteFloat(file, value[0])
-    WriteFloat(file, value[1])
-    WriteFloat(file, value[2])
-    WriteFloat(file, value[3])
-
-
-m = axis_conversion(from_forward="Z", from_up="Y", to_forward="-Y", to_up="Z").to_4x4()
+    file.write(_VECTOR4.pack(value[0], value[1], value[2], value[3]))
 
 
 def ReadQuaternion(file):
-    x = ReadFloat(file)
-    y = ReadFloat(file)
-    z = ReadFloat(file)
-    w = ReadFloat(file)
+    x, y, z, w = _VECTOR4.unpack_from(file.buf, file.offset)
+    file.offset += 16
     return Quaternion((w, x, -z, y))
 
 
 def WriteQuaternion(file, value):
-    WriteFloat(file, value.x)
-    WriteFloat(file, value.z)
-    WriteFloat(file, -value.y)
-    WriteFloat(file, value.w)
+    file.write(_VECTOR4.pack(value.x, value.z, -value.y, value.w))
 
 
 def ReadSBoneIndice(file):
-    arr = []
-    for i in range(KHM_MAX_BONE_INFLUENCES):
-        arr.append(ReadUChar(file))
-    return arr
+    value = list(_BONE_INDICE.unpack_from(file.buf, file.offset))
+    file.offset += KHM_MAX_BONE_INFLUENCES
+    return value
 
 
 def WriteSBoneIndice(file, arr):
-    for i in arr:
-        WriteUChar(file, i)
+    file.write(_BONE_INDICE.pack(*arr))
 
 
 def ReadMatrix(file):
-    r1 = (ReadFloat(file), ReadFloat(file), ReadFloat(file), ReadFloat(file))
-    r2 = (ReadFloat(file), ReadFloat(file), ReadFloat(file), ReadFloat(file))
-    r3 = (ReadFloat(file), ReadFloat(file), ReadFloat(file), ReadFloat(file))
-    r4 = (ReadFloat(file), ReadFloat(file), ReadFloat(file), ReadFloat(file))
+    v = _MATRIX.unpack_from(file.buf, file.offset)
+    file.offset += 64
 
-    pos, rot, sca = Matrix([r1, r2, r3, r4]).decompose()
+    pos, rot, sca = Matrix((v[0:4], v[4:8], v[8:12], v[12:16])).decompose()
     pos = Vector((pos.x, -pos.z, pos.y))
     rot = Quaternion((rot.w, rot.x, -rot.z, rot.y))
 
@@ -145,22 +252,28 @@ def WriteMatrix(file, value):
     rot = Quaternion((rot.w, rot.x, rot.z, -rot.y))
     value = Matrix.LocRotScale(pos, rot, sca)
 
-    for x in range(4):
-        for y in range(4):
-            WriteFloat(file, value[x][y])
+    file.write(_MATRIX.pack(*value[0], *value[1], *value[2], *value[3]))
 
 
 def ReadObjectName(file):
-    return file.read(KHM_MAX_OBJECT_NAME).decode("utf-8").replace("\u0000", "")
+    name = bytes(file.read(KHM_MAX_OBJECT_NAME))
+    # Names are NUL terminated, anything after the terminator is padding
+    end = name.find(b"\0")
+    if end != -1:
+        name = name[:end]
+    return name.decode("utf-8")
 
 
 def WriteObjectName(file, value):
-    byte_value = value.encode("utf_8")
+    byte_value = value.encode("utf_8")[:KHM_MAX_OBJECT_NAME]
+    # Truncating can split a multi-byte character, drop the partial bytes
+    byte_value = byte_value.decode("utf_8", "ignore").encode("utf_8")
     file.write(byte_value)
-    for i in range(KHM_MAX_OBJECT_NAME - len(value)):
-        file.write(b"\0")
+    file.write(_ZEROS[: KHM_MAX_OBJECT_NAME - len(byte_value)])
 
 
 def WriteNull(file, amount):
-    for i in range(amount):
-        file.write(b"\0")
+    while amount > len(_ZEROS):
+        file.write(_ZEROS)
+        amount -= len(_ZEROS)
+    file.write(_ZEROS[:amount])
@@ -1,7 +1,11 @@
+import contextlib
 import copy
+import io
 
 import bpy
 import mathutils
+import numpy as np
+from bpy_extras import anim_utils
 
 from .binary_io import *
 from .khm_objects import *
@@ -16,7 +20,7 @@ def SerializeCollisionData(context, b_obj, pMesh):
     pass
 
 
-def SerializeSkin(context, b_obj, all_vertexes, pMesh, pModelDefinition):
+def SerializeSkin(context, b_obj, vertex_groups, pMesh, pModelDefinition):
     if len(b_obj.vertex_groups) == 0:
         pMesh.pSkinWeights = None
         return
@@ -31,33 +35,45 @@ def SerializeSkin(context, b_obj, all_vertexes, pMesh, pModelDefinition):
             # Helpers in Blender have "HELPER_" prefix
             vg_name_to_bone_id["HELPER_" + helper.szName] = helper.uiId
 
-    pMesh.pSkinWeights = []
-    pMesh.pSkinBoneIndices = []
-    warned_groups = set()
-
-    for vertex in all_vertexes:
-        indices = []
-        weights = []
-        # vertex[3] is now a tuple of (group_index, weight) pairs
-        for group_idx, weight in vertex[3]:
-            # Get vertex group name from index, then map to bone ID
-            vg_name = b_obj.vertex_groups[group_idx].name
-            bone_id = vg_name_to_bone_id.get(vg_name)
-            if bone_id is None:
-                if vg_name not in warned_groups:
-                    print(f"[Warning] Vertex group '{vg_name}' does not match any bone/helper - weights will be lost")
-                    warned_groups.add(vg_name)
-                bone_id = 0
-            indices.append(bone_id)
-            weights.append(weight)
-        while len(indices) < KHM_MAX_BONE_INFLUENCES:
-            indices.append(0)
-        indices = indices[:KHM_MAX_BONE_INFLUENCES]
-        while len(weights) < KHM_MAX_BONE_INFLUENCES:
-            weights.append(0)
-        weights = weights[:KHM_MAX_BONE_INFLUENCES]
-        pMesh.pSkinBoneIndices.append(indices)
-        pMesh.pSkinWeights.append(weights)
+    # Resolve each vertex group index to its bone ID once, rather than per
+    # vertex influence
+    vg_idx_to_bone_id = []
+    for vg in b_obj.vertex_groups:
+        bone_id = vg_name_to_bone_id.get(vg.name)
+        if bone_id is None:
+            print(f"[Warning] Vertex group '{vg.name}' does not match any bone/helper - weights will be lost")
+            bone_id = 0
+        vg_idx_to_bone_id.append(bone_id)
+
+    pMesh.pSkinWeights = [None] * len(vertex_groups)
+    pMesh.pSkinBoneIndices = [None] * len(vertex_groups)
+
+    # vertex_groups holds a tuple of (group_index, weight) pairs per vertex
+    for v, groups in enumerate(vertex_groups):
+        indices = [0] * KHM_MAX_BONE_INFLUENCES
+        weights = [0.0] * KHM_MAX_BONE_INFLUENCES
+        for group_idx, weight in groups:
+            bone_id = vg_idx_to_bone_id[group_idx]
+
+            # Keep the strongest influences rather than the first ones Blender
+            # lists, insertion sorted so the weakest is always the last slot
+            if weight <= weights[-1]:
+                continue
+            k = KHM_MAX_BONE_INFLUENCES - 1
+            while k > 0 and weights[k - 1] < weight:
+                indices[k] = indices[k - 1]
+                weights[k] = weights[k - 1]
+                k -= 1
+            indices[k] = bone_id
+            weights[k] = weight
+
+        # Dropped influences and unnormalized paint would otherwise leave the
+        # vertex pulled towards the origin when skinned
+        total = sum(weights)
+        if total > 0:
+            weights = [w / total for w in weights]
+        pMesh.pSkinBoneIndices[v] = indices
+        pMesh.pSkinWeights[v] = weights
 
 
 def VertexAlias(point1, point2):
@@ -65,81 +81,106 @@ def VertexAlias(point1, point2):
 
 
 def SerializeGeometry(context, b_obj, pMesh, pModelDefinition):
-    bpy.ops.object.mode_set(mode="OBJECT")
-    bpy.context.view_layer.objects.active = b_obj
+    # Flush pending edit mode changes without leaving edit mode
+    if b_obj.mode == "EDIT":
+        b_obj.update_from_editmode()
 
-    # Triangulate using modifier (avoids edit mode crash on large meshes)
-    tri_mod = b_obj.modifiers.new(name="Triangulate_Export", type="TRIANGULATE")
+    # Triangulate through the evaluated mesh's loop triangles rather than a
+    # temporary modifier and a full mesh copy (avoids edit mode crash on large
+    # meshes). Modifiers still apply, as before.
     depsgraph = context.evaluated_depsgraph_get()
     b_obj_eval = b_obj.evaluated_get(depsgraph)
+    mesh = b_obj_eval.to_mesh()
+    mesh.calc_loop_triangles()
+
+    tris = mesh.loop_triangles
+    verts = mesh.vertices
+    loops = mesh.loops
+    uv_data = mesh.uv_layers.active.data
+    vcol_layer = mesh.vertex_colors[0].data if mesh.vertex_colors else None
+    has_colors = vcol_layer is not None
+
+    # Pull every attribute out in bulk rather than one RNA access per corner
+    co = np.empty(len(verts) * 3, dtype=np.float32)
+    verts.foreach_get("co", co)
+    normals = np.empty(len(verts) * 3, dtype=np.float32)
+    verts.foreach_get("normal", normals)
+    face_normals = np.empty(len(tris) * 3, dtype=np.float32)
+    tris.foreach_get("normal", face_normals)
+    corner_verts = np.empty(len(tris) * 3, dtype=np.int32)
+    tris.foreach_get("vertices", corner_verts)
+    corner_loops = np.empty(len(tris) * 3, dtype=np.int32)
+    tris.foreach_get("loops", corner_loops)
+    uvs = np.empty(len(loops) * 2, dtype=np.float32)
+    uv_data.foreach_get("uv", uvs)
+    if has_colors:
+        colors = np.empty(len(loops) * 4, dtype=np.float32)
+        vcol_layer.foreach_get("color", colors)
+        colors = colors.reshape(-1, 4)
+
+    co = co.reshape(-1, 3)
+    normals = normals.reshape(-1, 3)
+    uvs = uvs.reshape(-1, 2)
+
+    # Groups are a per-vertex property, convert them to simple tuples once
+    # per vertex and number the distinct ones so they can be compared as ints
+    vert_groups = [tuple((g.group, g.weight) for g in v.groups) for v in verts]
+    group_ids = {}
+    vert_group_ids = np.array(
+        [group_ids.setdefault(groups, len(group_ids)) for groups in vert_groups],
+        dtype=np.int32,
+    )
 
-    # Use evaluated mesh for export
-    b_obj_data_backup = b_obj.data
-    b_obj.data = bpy.data.meshes.new_from_object(b_obj_eval)
-    b_obj.modifiers.remove(tri_mod)
-
-    pMesh.pVertices = []
-    pMesh.pNormals = []
-    pMesh.pIndices = []
-    pMesh.pFaceNormals = []
-    if len(b_obj.data.vertex_colors) != 0:
-        pMesh.pColors = []
-    vertex_to_uv = {}
-    vertex_to_nrm = {}
-
-    all_vertexes = []
+    # Pack each corner's attributes into one integer row. The values are
+    # quantised first so vertices that only differ by float noise are welded
+    # together, colours at the 8 bit precision they're saved with.
+    rows = [
+        np.rint(co[corner_verts] * 1e5),
+        np.rint(uvs[corner_loops] * 1e4),
+        np.rint(normals[corner_verts] * 1e3),
+        vert_group_ids[corner_verts, None],
+    ]
+    if has_colors:
+        rows.append(np.rint(colors[corner_loops] * 255))
+    rows = np.concatenate(rows, axis=1).astype(np.int32)
+
+    # Deduplicate all corners at once. np.unique sorts the rows, so renumber
+    # the unique vertices by the corner they first appear at to keep the
+    # output in the same order as a first-come dict would.
+    _, first_corners, inverse = np.unique(
+        rows, axis=0, return_index=True, return_inverse=True
+    )
+    order = np.argsort(first_corners)
+    first_corners = first_corners[order]
+    renumber = np.empty_like(order)
+    renumber[order] = np.arange(len(order))
+
+    # Gather the unique vertices straight out of the attribute arrays
+    unique_verts = corner_verts[first_corners]
+    unique_loops = corner_loops[first_corners]
+    pMesh.pVertices = co[unique_verts]
+    pMesh.pNormals = normals[unique_verts]
+    pMesh.pIndices = renumber[inverse.reshape(-1)]
+    pMesh.pFaceNormals = face_normals.reshape(-1, 3)
+    if has_colors:
+        pMesh.pColors = colors[unique_loops]
 
     pMesh.numTxCoordMaps = 1  # todo multiple uv layers
-    pMesh.pTexCoords = []
-
-    # Use dict for O(1) vertex deduplication instead of O(n) list lookups
-    vertex_to_index = {}
-
-    for face in b_obj.data.polygons:
-        pMesh.pFaceNormals.append(tuple(face.normal))
-        for vert_idx, loop_idx in zip(face.vertices, face.loop_indices):
-            vert = b_obj.data.vertices[vert_idx]
-            uv = b_obj.data.uv_layers.active.data[loop_idx].uv
-            # Convert groups to a simple tuple for comparison
-            groups = tuple((g.group, g.weight) for g in vert.groups)
-
-            if len(b_obj.data.vertex_colors) != 0:
-                color = b_obj.data.vertex_colors[0].data[loop_idx].color
-                tup = (
-                    tuple(vert.co),
-                    tuple(uv),
-                    tuple(vert.normal),
-                    groups,
-                    color[0],
-                    color[1],
-                    color[2],
-                    color[3],
-                )
-            else:
-                tup = (tuple(vert.co), tuple(uv), tuple(vert.normal), groups)
-
-            if tup not in vertex_to_index:
-                vertex_to_index[tup] = len(all_vertexes)
-                all_vertexes.append(tup)
-            pMesh.pIndices.append(vertex_to_index[tup])
-
-    for vert in all_vertexes:
-        pMesh.pVertices.append(vert[0])  # co tuple
-        pMesh.pTexCoords.append(vert[1])  # uv tuple
-        pMesh.pNormals.append(vert[2])  # normal tuple
-        if len(b_obj.data.vertex_colors) != 0:
-            pMesh.pColors.append([vert[4], vert[5], vert[6], vert[7]])
+    pMesh.pTexCoords = [uvs[unique_loops]]
 
     pMesh.numVertices = len(pMesh.pVertices)
     pMesh.numIndices = len(pMesh.pIndices)
 
-    SerializeSkin(context, b_obj, all_vertexes, pMesh, pModelDefinition)
+    SerializeSkin(
+        context,
+        b_obj,
+        [vert_groups[v] for v in unique_verts.tolist()],
+        pMesh,
+        pModelDefinition,
+    )
     SerializeCollisionData(context, b_obj, pMesh)
 
-    # Restore original mesh data and clean up triangulated copy
-    triangulated_mesh = b_obj.data
-    b_obj.data = b_obj_data_backup
-    bpy.data.meshes.remove(triangulated_mesh)
+    b_obj_eval.to_mesh_clear()
 
 
 def SerializeHelpersAndCollisions(context, b_obj, pModelDefinition):
@@ -150,73 +191,70 @@ def SerializeHelpersAndCollisions(context, b_obj, pModelDefinition):
     helpers = []
 
     pMesh = pModelDefinition.pMesh
-    pMesh.min = Vector((0, 0, 0))
-    pMesh.max = Vector((0, 0, 0))
+    pMesh.min = np.zeros(3)
+    pMesh.max = np.zeros(3)
     pMesh.volume = 0.0
 
-    for ob in bpy.data.objects:
-        if ob.parent == b_obj:
-            if ob.name.startswith("COL_"):
-                print("FOUND COL", ob.name)
-                col_type = ob.name[4:]
-                collision = sCollisionShape()
-
-                bbox_corners = [
-                    ob.matrix_world @ Vector(corner) for corner in ob.bound_box
-                ]
-                for bbox_corner in bbox_corners:
-                    for i in range(3):
-                        if bbox_corner[i] < pMesh.min[i]:
-                            pMesh.min[i] = bbox_corner[i]
-                        if bbox_corner[i] > pMesh.max[i]:
-                            pMesh.max[i] = bbox_corner[i]
-
-                if col_type.startswith("SPHERE"):
-                    collision.setSphere(ob.scale.x)
-                    collision.collisionType = 0
-                    loc = ob.matrix_world.to_translation()
-                    rot = ob.matrix_world.to_quaternion()
-                    sca = Vector((1, 1, 1))
-                    collision.transform = mathutils.Matrix.LocRotScale(loc, rot, sca)
-                    pModelDefinition.pMesh.pCollisions.append(collision)
-                elif col_type.startswith("BOX"):
-                    collision.collisionType = 1
-
-                    old_scale = Vector((ob.scale[0], ob.scale[1], ob.scale[2]))
-                    ob.scale = Vector((1, 1, 1))
-
-                    bpy.context.view_layer.update()
-
-                    loc = ob.matrix_world.to_translation()
-                    rot = ob.matrix_world.to_quaternion()
-                    sca = ob.matrix_world.to_scale()
-                    collision.transform = mathutils.Matrix.LocRotScale(loc, rot, sca)
-                    ob.scale = old_scale
-                    pModelDefinition.pMesh.pCollisions.append(collision)
-                    # Reverse the import swizzle: import does [x, -z, y], so export does [x, z, -y]
-                    collision.setBox([ob.scale[0], ob.scale[2], -ob.scale[1]])
-
-                elif col_type.startswith("CAPSULE"):
-                    # Since we spawned a cylinder rather than a capsule, adjust for the extra height with -0.2488
-                    collision.setCapsule(ob.scale.x, ob.scale.z - 0.2488)
-                    collision.collisionType = 2
-                    loc = ob.matrix_world.to_translation()
-                    rot = ob.matrix_world.to_quaternion()
-                    sca = Vector((1, 1, 1))
-                    collision.transform = mathutils.Matrix.LocRotScale(loc, rot, sca)
-                    pModelDefinition.pMesh.pCollisions.append(collision)
-                elif col_type.startswith("CONVEX_MESH"):
-                    print("[ERROR] Unimplimented collision type: Convex Mesh!")
-
-            elif ob.name.startswith("HELPER_"):
-                helper = sObjectBase()
-                helper.szName = ob.name[7:]
-                helper.uiId = len(pModelDefinition.obj_to_id)
-                pModelDefinition.obj_to_id[helper.uiId] = ob
-                helper.matLocal = ob.matrix_world
-                helper.matGlobal = ob.matrix_world
-                pModelDefinition.lHelpers.append(helper)
-                helpers.append(helper)
+    for ob in b_obj.children:
+        if ob.name.startswith("COL_"):
+            print("FOUND COL", ob.name)
+            col_type = ob.name[4:]
+            collision = sCollisionShape()
+
+            # Transform all 8 local bound box corners to world space at once
+            matrix_world = np.asarray(ob.matrix_world)
+            bbox_corners = (
+                np.asarray(ob.bound_box) @ matrix_world[:3, :3].T + matrix_world[:3, 3]
+            )
+            pMesh.min = np.minimum(pMesh.min, bbox_corners.min(axis=0))
+            pMesh.max = np.maximum(pMesh.max, bbox_corners.max(axis=0))
+
+            if col_type.startswith("SPHERE"):
+                collision.setSphere(ob.scale.x)
+                collision.collisionType = 0
+                loc = ob.matrix_world.to_translation()
+                rot = ob.matrix_world.to_quaternion()
+                sca = Vector((1, 1, 1))
+                collision.transform = mathutils.Matrix.LocRotScale(loc, rot, sca)
+                pModelDefinition.pMesh.pCollisions.append(collision)
+            elif col_type.startswith("BOX"):
+                collision.collisionType = 1
+
+                old_scale = Vector((ob.scale[0], ob.scale[1], ob.scale[2]))
+                ob.scale = Vector((1, 1, 1))
+
+                bpy.context.view_layer.update()
+
+                loc = ob.matrix_world.to_translation()
+                rot = ob.matrix_world.to_quaternion()
+                sca = ob.matrix_world.to_scale()
+                collision.transform = mathutils.Matrix.LocRotScale(loc, rot, sca)
+                ob.scale = old_scale
+                pModelDefinition.pMesh.pCollisions.append(collision)
+                # Reverse the import swizzle: import does [x, -z, y], so export does [x, z, -y]
+                collision.setBox([ob.scale[0], ob.scale[2], -ob.scale[1]])
+
+            elif col_type.startswith("CAPSULE"):
+                # Since we spawned a cylinder rather than a capsule, adjust for the extra height with -0.2488
+                collision.setCapsule(ob.scale.x, ob.scale.z - 0.2488)
+                collision.collisionType = 2
+                loc = ob.matrix_world.to_translation()
+                rot = ob.matrix_world.to_quaternion()
+                sca = Vector((1, 1, 1))
+                collision.transform = mathutils.Matrix.LocRotScale(loc, rot, sca)
+                pModelDefinition.pMesh.pCollisions.append(collision)
+            elif col_type.startswith("CONVEX_MESH"):
+                print("[ERROR] Unimplimented collision type: Convex Mesh!")
+
+        elif ob.name.startswith("HELPER_"):
+            helper = sObjectBase()
+            helper.szName = ob.name[7:]
+            helper.uiId = len(pModelDefinition.obj_to_id)
+            pModelDefinition.obj_to_id[helper.uiId] = ob
+            helper.matLocal = ob.matrix_world
+            helper.matGlobal = ob.matrix_world
+            pModelDefinition.lHelpers.append(helper)
+            helpers.append(helper)
 
     for helper in helpers:
         helper.uiParentId = len(pModelDefinition.obj_to_id)
@@ -225,25 +263,58 @@ def SerializeHelpersAndCollisions(context, b_obj, pModelDefinition):
     pModelDefinition.pMesh.numCollisions = len(pModelDefinition.pMesh.pCollisions)
 
     # swap y and z for max and min bbox
-    max_z = pMesh.max[2]
-    pMesh.max[2] = pMesh.max[1]
-    pMesh.max[1] = max_z
-    min_z = pMesh.min[2]
-    pMesh.min[2] = pMesh.min[1]
-    pMesh.min[1] = min_z
+    pMesh.min = Vector((pMesh.min[0], pMesh.min[2], pMesh.min[1]))
+    pMesh.max = Vector((pMesh.max[0], pMesh.max[2], pMesh.max[1]))
     return
 
 
+@contextlib.contextmanager
+def ObjectMode(b_obj, mode):
+    """
+    Switch the active object b_obj into mode for the duration of the block.
+
+    mode_set pushes an undo step and flushes the depsgraph, so it's skipped
+    when the object is already in the requested mode.
+    """
+    previous_mode = b_obj.mode
+    if previous_mode != mode:
+        bpy.ops.object.mode_set(mode=mode)
+    try:
+        yield
+    finally:
+        if previous_mode != mode:
+            bpy.ops.object.mode_set(mode=previous_mode)
+
+
+def GetBoneLocalMatrices(b_obj):
+    # Needs b_obj to be in edit mode
+    local_matrices = {}
+    for edit_bone in b_obj.data.edit_bones:
+        if edit_bone.parent is not None:
+            local_matrix = edit_bone.parent.matrix.inverted() @ edit_bone.matrix
+        else:
+            local_matrix = edit_bone.matrix.copy()
+        local_matrices[edit_bone.name] = local_matrix
+    return local_matrices
+
+
 def SerializeBones(context, b_obj, pModelDefinition):
     pModelDefinition.numBones = 0
     pModelDefinition.lBones = []
     if b_obj.type != "ARMATURE":
         return
 
-    bpy.ops.object.mode_set(mode="EDIT")
+    with ObjectMode(b_obj, "EDIT"):
+        SerializeEditBones(b_obj, pModelDefinition)
 
+
+def SerializeEditBones(b_obj, pModelDefinition):
     pModelDefinition.numBones = len(b_obj.data.edit_bones)
 
+    # Kept on the model so the animation export doesn't re-enter edit mode
+    local_matrices = GetBoneLocalMatrices(b_obj)
+    pModelDefinition.bone_local_matrices = local_matrices
+
     obj_to_id = pModelDefinition.obj_to_id
 
     helpers = []
@@ -271,10 +342,7 @@ def SerializeBones(context, b_obj, pModelDefinition):
         else:
             bone.uiParentId = obj_to_id.get(edit_bone.parent, -1)
         bone.matGlobal = edit_bone.matrix
-        if edit_bone.parent is not None:
-            bone.matLocal = edit_bone.parent.matrix.inverted() @ edit_bone.matrix
-        else:
-            bone.matLocal = edit_bone.matrix
+        bone.matLocal = local_matrices[edit_bone.name]
         pModelDefinition.lBones.append(bone)
 
     for helper in helpers:
@@ -286,15 +354,10 @@ def SerializeBones(context, b_obj, pModelDefinition):
         else:
             bone.uiParentId = obj_to_id.get(helper.parent, -1)
         bone.matGlobal = helper.matrix
-        if helper.parent is not None:
-            bone.matLocal = helper.parent.matrix.inverted() @ helper.matrix
-        else:
-            bone.matLocal = helper.matrix
+        bone.matLocal = local_matrices[helper.name]
         pModelDefinition.lHelpers.append(bone)
         pModelDefinition.numBones -= 1
 
-    bpy.ops.object.mode_set(mode="OBJECT")
-
 
 def SerializeModel(context, pModelDefinition):
     b_obj = context.object
@@ -310,9 +373,9 @@ def SerializeModel(context, pModelDefinition):
 
     if b_obj.type == "ARMATURE":
         attached_meshes = []
-        for obj in bpy.data.objects:
+        for obj in b_obj.children:
             # Skip collision meshes when looking for the main mesh
-            if obj.parent == b_obj and obj.type == "MESH" and "COL_" not in obj.name:
+            if obj.type == "MESH" and not obj.name.startswith("COL_"):
                 attached_meshes.append(obj)
         if len(attached_meshes) != 1:
             print(
@@ -330,6 +393,101 @@ def SerializeModel(context, pModelDefinition):
     pObject.uiParentId = -1
 
 
+def GetBoneChannels(b_obj, pose_bones):
+    """
+    Find the action fcurves animating each pose bone's location, rotation and
+    scale, so frames can be sampled without a depsgraph update per frame.
+
+    Returns None when the pose can't be rebuilt from the action alone, in
+    which case the frames have to be evaluated with frame_set.
+    """
+    anim_data = b_obj.animation_data
+    if anim_data is None or anim_data.action is None:
+        return None
+    if anim_data.drivers or anim_data.nla_tracks:
+        return None
+    if any(pose_bone.rotation_mode != "QUATERNION" for pose_bone in pose_bones):
+        return None
+
+    fcurves = {}
+    channelbag = anim_utils.action_get_channelbag_for_slot(
+        anim_data.action, anim_data.action_slot
+    )
+    if channelbag is not None:
+        for fcurve in channelbag.fcurves:
+            # frame_set doesn't apply muted curves, so the static value stands
+            if fcurve.mute or (fcurve.group is not None and fcurve.group.mute):
+                continue
+            fcurves[(fcurve.data_path, fcurve.array_index)] = fcurve
+
+    channels = []
+    for pose_bone in pose_bones:
+        path = 'pose.bones["%s"].' % bpy.utils.escape_identifier(pose_bone.name)
+        channels.append(
+            tuple(
+                [fcurves.get((path + prop, i)) for i in range(size)]
+                for prop, size in (
+                    ("location", 3),
+                    ("rotation_quaternion", 4),
+                    ("scale", 3),
+                )
+            )
+        )
+    return channels
+
+
+def SampleMatrixBasis(pose_bone, channels, frame):
+    # Channels without an fcurve keep the bone's static value
+    loc, rot, sca = (
+        [fcurve.evaluate(frame) if fcurve else v for fcurve, v in zip(curves, values)]
+        for curves, values in zip(
+            channels,
+            (pose_bone.location, pose_bone.rotation_quaternion, pose_bone.scale),
+        )
+    )
+    return mathutils.Matrix.LocRotScale(
+        Vector(loc), mathutils.Quaternion(rot).normalized(), Vector(sca)
+    )
+
+
+def DecomposeRotationScale(matrices):
+    """
+    Split an array of 3x3 matrices into (w, x, y, z) quaternions and scales,
+    matching mathutils: scale is the length of each column, negated along
+    with the rotation when the matrix flips handedness.
+    """
+    scales = np.linalg.norm(matrices, axis=-2)
+    rot = matrices / np.where(scales == 0, 1, scales)[..., None, :]
+    negative = np.linalg.det(rot) < 0
+    rot[negative] *= -1
+    scales[negative] *= -1
+
+    m00, m01, m02 = rot[..., 0, 0], rot[..., 0, 1], rot[..., 0, 2]
+    m10, m11, m12 = rot[..., 1, 0], rot[..., 1, 1], rot[..., 1, 2]
+    m20, m21, m22 = rot[..., 2, 0], rot[..., 2, 1], rot[..., 2, 2]
+
+    # Build each quaternion from whichever component is largest, which keeps
+    # the division away from zero
+    candidates = np.stack(
+        [
+            (1 + m00 + m11 + m22, m21 - m12, m02 - m20, m10 - m01),
+            (m21 - m12, 1 + m00 - m11 - m22, m01 + m10, m02 + m20),
+            (m02 - m20, m01 + m10, 1 - m00 + m11 - m22, m12 + m21),
+            (m10 - m01, m02 + m20, m12 + m21, 1 - m00 - m11 + m22),
+        ]
+    )  # (case, component, ...)
+    diagonal = np.stack(
+        [candidates[0, 0], candidates[1, 1], candidates[2, 2], candidates[3, 3]]
+    )
+    case = np.argmax(diagonal, axis=0)
+    quats = np.take_along_axis(candidates, case[None, None], axis=0)[0]
+    quats = np.moveaxis(quats, 0, -1)
+    quats /= np.linalg.norm(quats, axis=-1, keepdims=True)
+    # Pick the hemisphere with a positive w, like mathutils does
+    quats[quats[..., 0] < 0] *= -1
+    return quats, scales
+
+
 def SerializeAnimation(context, pModelDefinition):
     b_obj = context.object
     scene = context.scene
@@ -343,65 +501,71 @@ def SerializeAnimation(context, pModelDefinition):
         return
 
     pModelDefinition.pAnimation = sAnimation()
-    bpy.ops.object.mode_set(mode="POSE")
 
     pModelDefinition.pAnimation.numNodeFrames = scene.frame_end
     pModelDefinition.pAnimation.frameDurationMs = 1 / scene.render.fps * 1000
     pModelDefinition.pAnimation.numNodes = len(b_obj.pose.bones)
-    pModelDefinition.pAnimation.pNodeTransforms = []
     pModelDefinition.pAnimation.pNodeAnimations = []
     pModelDefinition.pAnimation.startTimeS = 0.0
     pModelDefinition.pAnimation.endTimeS = (
         (scene.frame_end - 1) * pModelDefinition.pAnimation.frameDurationMs / 1000
     )
 
-    bones_to_keyframes = {}
+    pose_bones = list(b_obj.pose.bones)
+    names = [pose_bone.name for pose_bone in pose_bones]
 
-    local_matrixes = []
-    bpy.ops.object.mode_set(mode="EDIT")
-    for n in range(pModelDefinition.pAnimation.numNodes):
-        if b_obj.data.edit_bones[n].parent is not None:
-            local_matrix = (
-                b_obj.data.edit_bones[n].parent.matrix.inverted()
-                @ b_obj.data.edit_bones[n].matrix
-            )
-        else:
-            local_matrix = b_obj.data.edit_bones[n].matrix
-        local_matrixes.append(local_matrix)
+    # Reuse the rest matrices gathered while exporting the bones, so edit mode
+    # is only entered once per export
+    bone_local_matrices = pModelDefinition.bone_local_matrices
+    if bone_local_matrices is None:
+        with ObjectMode(b_obj, "EDIT"):
+            bone_local_matrices = GetBoneLocalMatrices(b_obj)
+    local_matrixes = [bone_local_matrices[name] for name in names]
 
-    bpy.ops.object.mode_set(mode="POSE")
+    # These only depend on the rest pose, so work them out once per bone
+    # rather than once per frame
+    local_inverted_t = np.array([m.inverted().transposed() for m in local_matrixes])
+    local_trans = np.array([m.to_translation() for m in local_matrixes])
 
-    for n in range(len(b_obj.pose.bones)):
+    for n, name in enumerate(names):
         pNodeAnimation = sNodeAnimation()
         pNodeAnimation.uiNodeId = n
-        pNodeAnimation.szNodeName = b_obj.pose.bones[n].name
+        pNodeAnimation.szNodeName = name
         pModelDefinition.pAnimation.pNodeAnimations.append(pNodeAnimation)
 
-    for f in range(scene.frame_end):
-        scene.frame_set(f)
-
-        for n in range(len(b_obj.pose.bones)):
-            transform = sNodeTransform()
+    # Pose matrices are gathered into one array, laid out node by node with
+    # all frames of a node next to each other as in the file
+    num_nodes = len(pose_bones)
+    num_frames = scene.frame_end
+    bases = np.empty((num_nodes, num_frames, 4, 4))
 
-            pose_bone = b_obj.pose.bones[n]
+    bone_channels = GetBoneChannels(b_obj, pose_bones)
 
-            matrix = (
-                pose_bone.matrix_basis.transposed() @ local_matrixes[n].inverted()
-            ).transposed()
+    for f in range(num_frames):
+        if bone_channels is None:
+            scene.frame_set(f)
 
-            transform.vTrans, transform.qRot, transform.vScale = matrix.decompose()
-            transform.vTrans += local_matrixes[n].to_translation()
-
-            if pose_bone.name not in bones_to_keyframes:
-                bones_to_keyframes[pose_bone.name] = []
-            bones_to_keyframes[pose_bone.name].append(transform)
-
-    for bone in bones_to_keyframes:
-        for keyframe in bones_to_keyframes[bone]:
-            pModelDefinition.pAnimation.pNodeTransforms.append(keyframe)
+        for n, pose_bone in enumerate(pose_bones):
+            if bone_channels is None:
+                matrix_basis = pose_bone.matrix_basis
+            else:
+                matrix_basis = SampleMatrixBasis(pose_bone, bone_channels[n], f)
+            bases[n, f] = matrix_basis
+
+    # (basis^T @ local^-1)^T for every keyframe in one batched matmul, then
+    # decompose it the same way Matrix.decompose() does
+    matrices = local_inverted_t[:, None] @ bases
+    translations = matrices[..., :3, 3] + local_trans[:, None]
+    rotations, scales = DecomposeRotationScale(matrices[..., :3, :3])
+
+    # Swizzle back to KHM axes: quaternion (x, z, -y, w), vectors (x, z, -y)
+    transforms = np.empty((num_nodes, num_frames), dtype=NODE_TRANSFORM_DTYPE)
+    transforms["qRot"] = rotations[..., (1, 3, 2, 0)] * (1, 1, -1, 1)
+    transforms["vTrans"] = translations[..., (0, 2, 1)] * (1, 1, -1)
+    transforms["vScale"] = scales
+    pModelDefinition.pAnimation.pNodeTransforms = transforms
 
     scene.frame_set(1)
-    bpy.ops.object.mode_set(mode="OBJECT")
 
 
 def SerializeAnimationMask(context, pModelDefinition):
@@ -416,10 +580,9 @@ def SerializeAnimationMask(context, pModelDefinition):
         return
 
     pModelDefinition.pAnimationMask = sAnimationMask()
-    bpy.ops.object.mode_set(mode="POSE")
     for pose_bone in b_obj.pose.bones:
         animation_mask_entry = sAnimationMaskEntry()
-        animation_mask_entry.szName = pose_bone.name
+        animation_mask_entry.szNodeName = pose_bone.name
         if pose_bone.bone.select is True:
             animation_mask_entry.mask = 1
         else:
@@ -452,14 +615,12 @@ def SaveHelpers(file, pModelDefinition):
 
 
 def SaveSkin(file, pMesh):
-    WriteUChar(file, pMesh.pSkinWeights != None)
+    WriteUChar(file, pMesh.pSkinWeights is not None)
 
-    if pMesh.pSkinWeights != None:
-        for v in range(pMesh.numVertices):
-            WriteVector4(file, pMesh.pSkinWeights[v])
-    if pMesh.pSkinBoneIndices != None:
-        for v in range(pMesh.numVertices):
-            WriteSBoneIndice(file, pMesh.pSkinBoneIndices[v])
+    if pMesh.pSkinWeights is not None:
+        WriteFloatArray(file, np.asarray(pMesh.pSkinWeights)[: pMesh.numVertices])
+    if pMesh.pSkinBoneIndices is not None:
+        WriteUCharArray(file, np.asarray(pMesh.pSkinBoneIndices)[: pMesh.numVertices])
 
 
 def SaveCollisionData(file, pMesh):
@@ -470,57 +631,44 @@ def SaveCollisionData(file, pMesh):
         WriteUInt(file, col.collisionType)
         WriteMatrix(file, col.transform)
         if col.collisionType == 0:  # "SPHERE"
-            WriteFloat(file, col.sphere.radius)
+            WriteFloat(file, col.radius)
         elif col.collisionType == 1:  # "BOX"
-            WriteFloat(file, col.box.extents[0])
-            WriteFloat(file, col.box.extents[1])
-            WriteFloat(file, col.box.extents[2])
+            WriteFloat(file, col.extents[0])
+            WriteFloat(file, col.extents[1])
+            WriteFloat(file, col.extents[2])
         elif col.collisionType == 2:  # "CAPSULE"
-            WriteFloat(file, col.capsule.radius)
-            WriteFloat(file, col.capsule.halfHeight)
+            WriteFloat(file, col.radius)
+            WriteFloat(file, col.halfHeight)
         elif col.collisionType == 3:  # "CONVEX MESH"
             WriteInt(file, col.mesh.numPolys)
-            for poly in col.mesh.pPolygons:
-                WriteVector3(file, poly.normal)
-                WriteFloat(file, poly.d)
-                WriteShort(file, poly.numIndices)
-                WriteShort(file, poly.indexStart)
+            WriteCollisionPolygonArray(file, col.mesh.pPolygons)
             WriteInt(file, col.mesh.numIndices)
-            for indice in col.mesh.pIndices:
-                WriteUShort(file, indice)
+            WriteUShortArray(file, col.mesh.pIndices)
             WriteInt(file, col.mesh.numVertices)
-            for vert in col.mesh.pVertices:
-                WriteVector3(vert)
+            WriteFloatArray(file, col.mesh.pVertices)
 
 
 def SaveGeometry(file, pMesh):
     WriteInt(file, pMesh.numVertices)
-    for vertex in pMesh.pVertices:
-        WriteSwizzledVector3(file, vertex)
-    for normal in pMesh.pNormals:
-        WriteSwizzledVector3(file, normal)
+    WriteSwizzledVector3Array(file, pMesh.pVertices)
+    WriteSwizzledVector3Array(file, pMesh.pNormals)
     WriteInt(file, pMesh.numIndices)
-    for index in pMesh.pIndices:
-        WriteUShort(file, index)
-    for normal in pMesh.pFaceNormals:
-        WriteSwizzledVector3(file, normal)
-
-    WriteUChar(file, pMesh.pColors != None)
-    if pMesh.pColors != None:
-        for color in pMesh.pColors:
-            WriteUChar(file, int(color[0] * 255))
-            WriteUChar(file, int(color[1] * 255))
-            WriteUChar(file, int(color[2] * 255))
-            WriteUChar(file, int(color[3] * 255))
+    WriteUShortArray(file, pMesh.pIndices)
+    WriteSwizzledVector3Array(file, pMesh.pFaceNormals)
+
+    WriteUChar(file, pMesh.pColors is not None)
+    if pMesh.pColors is not None:
+        colors = np.clip(np.asarray(pMesh.pColors, dtype=np.float64) * 255, 0, 255)
+        WriteUCharArray(file, colors.astype(np.uint8))
 
     WriteUInt(file, pMesh.numTxCoordMaps)
 
     for i in range(pMesh.numTxCoordMaps):
         if i == 1:
-            WriteNull(8 * pMesh.numVertices)
-        for j in range(pMesh.numVertices):
-            WriteFloat(file, pMesh.pTexCoords[j * (i + 1)][0])
-            WriteFloat(file, 1 - (pMesh.pTexCoords[j * (i + 1)][1]))
+            WriteNull(file, 8 * pMesh.numVertices)
+        uvs = np.array(pMesh.pTexCoords[i], dtype=np.float64).reshape(-1, 2)
+        uvs[:, 1] = 1 - uvs[:, 1]
+        WriteFloatArray(file, uvs)
 
     SaveSkin(file, pMesh)
 
@@ -562,10 +710,7 @@ def SaveAnimation(file, pModelDefinition):
         WriteUInt(file, pNodeAnimation.uiNodeId)
         WriteObjectName(file, pNodeAnimation.szNodeName)
 
-    for transform in pAnimation.pNodeTransforms:
-        WriteQuaternion(file, transform.qRot)
-        WriteSwizzledVector3(file, transform.vTrans)
-        WriteVector3(file, transform.vScale)
+    WriteNodeTransformArray(file, pAnimation.pNodeTransforms)
 
 
 def SaveAnimationMask(file, pModelDefinition):
@@ -589,9 +734,6 @@ def SaveModel(file, pModelDefinition):
 def ExportModel(
     context, filepath, export_mesh, export_animation, export_animation_mask
 ):
-    file = open(filepath, "wb")
-    sHeader.export(file)
-
     if len(bpy.context.selected_objects) == 0:
         print("[Error] ExportModel: No object was selected to export.")
         return {"FINISHED"}
@@ -608,12 +750,16 @@ def ExportModel(
     if export_animation_mask == True:
         SerializeAnimationMask(context, pModelDefinition)
 
+    # Build the whole file in memory and write it to disk in one go
+    file = io.BytesIO()
+    sHeader.export(file)
     SaveModel(file, pModelDefinition)
 
-    # file2 = open("H:\\DK2\\exportjson.json", "w+")
-    # file2.write(json.dumps(pModelDefinition.toJSON(), sort_keys=True, indent=4))
-    # file2.close()
-    file.close()
+    with open(filepath, "wb") as f:
+        f.write(file.getbuffer())
+
+    # with open("H:\\DK2\\exportjson.json", "w") as file2:
+    #     pModelDefinition.writeJSON(file2)
     return {"FINISHED"}
 
 
@@ -1,9 +1,10 @@
-import hashlib
 import math
+import mmap
 import os
 
 import bpy
 import mathutils
+import numpy as np
 from mathutils import Vector
 
 from .binary_io import *
@@ -14,28 +15,41 @@ KHM_MAX_OBJECT_NAME = 48
 KHM_MAX_BONE_INFLUENCES = 4
 KHM_MAX_BONES = 64
 
+# Print progress while decoding
+DEBUG = False
+
 
 def ReadSkin(file, pMesh):
-    print("ReadSkin", file.tell())
+    if DEBUG:
+        print("ReadSkin", file.tell())
     hasSkin = ReadUChar(file)
-    print("hasSkin", hasSkin)
+    if DEBUG:
+        print("hasSkin", hasSkin)
     if hasSkin == 0:
-        print("No Skin")
+        if DEBUG:
+            print("No Skin")
         return  # no skin
 
-    pMesh.pSkinWeights = []
-    for i in range(pMesh.numVertices):
-        pMesh.pSkinWeights.append(ReadVector4(file))
-    pMesh.pSkinBoneIndices = []
-    for i in range(pMesh.numVertices):
-        pMesh.pSkinBoneIndices.append(ReadSBoneIndice(file))
+    pMesh.pSkinWeights = ReadFloatArray(
+        file, KHM_MAX_BONE_INFLUENCES * pMesh.numVertices
+    ).reshape(-1, KHM_MAX_BONE_INFLUENCES)
+    pMesh.pSkinBoneIndices = ReadUCharArray(
+        file, KHM_MAX_BONE_INFLUENCES * pMesh.numVertices
+    ).reshape(-1, KHM_MAX_BONE_INFLUENCES)
 
 
 def ReadCollisionData(file, pMesh):
-    print("ReadCollisionData", file.tell())
+    if DEBUG:
+        print("ReadCollisionData", file.tell())
     pMesh.numCollisions = ReadInt(file)
     if pMesh.numCollisions == 0:
-        print("no Collisions")
+        if DEBUG:
+            print("no Collisions")
+
+    # Accumulate the collision volume while reading. Mesh collisions use the
+    # mesh bounds, which come after the collision data, so only count them
+    pMesh.volume = 0.0
+    numMeshCollisions = 0
 
     pMesh.pCollisions = []
     for c in range(pMesh.numCollisions):
@@ -50,7 +64,6 @@ def ReadCollisionData(file, pMesh):
             y = ReadFloat(file)
             z = ReadFloat(file)
             col.setBox([x, -z, y])
-            print("Read the box matrix as", col.transform)
         elif col.collisionType == 2:  # "CAPSULE"
             col.setCapsule(ReadFloat(file), ReadFloat(file))
         elif col.collisionType == 3:  # CONVEX_MESH"
@@ -58,101 +71,91 @@ def ReadCollisionData(file, pMesh):
             col.bShared = True
 
             col.mesh.numPolys = ReadInt(file)
-            col.mesh.pPolygons = []
-            for p in range(col.mesh.numPolys):
-                col.mesh.pPolygons.append(sCollisionPolygon(file))
+            col.mesh.pPolygons = ReadCollisionPolygonArray(file, col.mesh.numPolys)
 
             col.mesh.numIndices = ReadInt(file)
-            col.mesh.pIndices = []
-            for p in range(col.mesh.numIndices):
-                col.mesh.pIndices.append(ReadUShort(file))
+            col.mesh.pIndices = ReadUShortArray(file, col.mesh.numIndices)
 
             col.mesh.numVertices = ReadInt(file)
-            col.mesh.pVertices = []
-            for p in range(col.mesh.numVertices):
-                col.mesh.pVertices.append(ReadVector3(file))
+            col.mesh.pVertices = ReadFloatArray(
+                file, 3 * col.mesh.numVertices
+            ).reshape(-1, 3)
         else:
             print(
                 "[Error] CLoader::ReadCollisionData(file, pMesh) - unknown collision type"
             )
 
+        if col.collisionType == 3 or col.collisionType == 4:  # CONVEX_MESH or MESH
+            numMeshCollisions += 1
+        else:
+            pMesh.volume += col.GetVolume()
+
+    return numMeshCollisions
+
 
 def ReadGeometry(file, pMesh):
-    print("ReadGeometry", file.tell())
+    if DEBUG:
+        print("ReadGeometry", file.tell())
     # read verts
     pMesh.numVertices = ReadInt(file)
-    pMesh.pVertices = []
-    for i in range(pMesh.numVertices):
-        pMesh.pVertices.append(ReadSwizzledVector3(file))
+    pMesh.pVertices = ReadSwizzledVector3Array(file, pMesh.numVertices)
 
     # read normals
-    pMesh.pNormals = []
-    for i in range(pMesh.numVertices):
-        pMesh.pNormals.append(ReadSwizzledVector3(file))
+    pMesh.pNormals = ReadSwizzledVector3Array(file, pMesh.numVertices)
 
     # read triangle indices
     pMesh.numIndices = ReadInt(file)
-    pMesh.pIndices = []
-    for i in range(pMesh.numIndices):
-        pMesh.pIndices.append(ReadUShort(file))
+    pMesh.pIndices = ReadUShortArray(file, pMesh.numIndices)
 
     # read face normals
     uiNumFaces = int(pMesh.numIndices / 3)
-    pMesh.pFaceNormals = []
-    for i in range(uiNumFaces):
-        pMesh.pFaceNormals.append(ReadSwizzledVector3(file))
+    pMesh.pFaceNormals = ReadSwizzledVector3Array(file, uiNumFaces)
 
     # read vtx colors
     hasVertColors = ReadUChar(file)
     if hasVertColors == 1:
-        pMesh.pColors = []
-        for i in range(pMesh.numVertices):
-            color_set = []
-            color_set.append(ReadUChar(file) / 255.0)
-            color_set.append(ReadUChar(file) / 255.0)
-            color_set.append(ReadUChar(file) / 255.0)
-            color_set.append(ReadUChar(file) / 255.0)
-            pMesh.pColors.append(color_set)
-            # pMesh.pColors.append(ReadUInt(file))
+        pMesh.pColors = (
+            ReadUCharArray(file, 4 * pMesh.numVertices).reshape(-1, 4) / 255.0
+        )
 
     # read tx coords
     pMesh.numTxCoordMaps = ReadUInt(file)
     pMesh.pTexCoords = []
     for i in range(pMesh.numTxCoordMaps):
         if i == 1:
+            # The exporter pads the second map with one unused block of
+            # 2 floats per vertex; step over it without copying
             file.read(8 * pMesh.numVertices)
-        for j in range(pMesh.numVertices):
-            vectorCoord = (ReadFloat(file), 1 - ReadFloat(file))  # Flip Y
-            pMesh.pTexCoords.append(vectorCoord)
+        uvs = ReadFloatArray(file, 2 * pMesh.numVertices).reshape(-1, 2)
+        uvs[:, 1] = 1 - uvs[:, 1]  # Flip Y
+        pMesh.pTexCoords.append(uvs)
 
     # read skin
     ReadSkin(file, pMesh)
 
     # read collision data
-    ReadCollisionData(file, pMesh)
+    numMeshCollisions = ReadCollisionData(file, pMesh)
 
-    print("ReadBounds", file.tell())
+    if DEBUG:
+        print("ReadBounds", file.tell())
 
     # read bounds
     pMesh.min = ReadVector3(file)
     pMesh.max = ReadVector3(file)
 
     # compute volume at load time (TODO: this is exporter's job)
-    pMesh.volume = 0.0
-    for i in range(pMesh.numCollisions):
-        col = pMesh.pCollisions[i]
-        if col.collisionType == 3 or col.collisionType == 4:  # CONVEX_MESH or MESH
-            s = pMesh.max - pMesh.min
-            pMesh.volume += s[0] * s[1] * s[2]
-        else:
-            pMesh.volume += col.GetVolume()
+    if numMeshCollisions:
+        s = pMesh.max - pMesh.min
+        pMesh.volume += numMeshCollisions * s[0] * s[1] * s[2]
 
 
 def ReadMeshes(file, pModelDefinition):
-    print("ReadMeshes", file.tell())
+    if DEBUG:
+        print("ReadMeshes", file.tell())
     count = ReadUChar(file)
     if count == 0:
-        print("No mesh")
+        if DEBUG:
+            print("No mesh")
         return
 
     pModelDefinition.pMesh = sObjectMesh()
@@ -174,10 +177,12 @@ def ReadMeshes(file, pModelDefinition):
 
 
 def ReadBones(file, pModelDefinition):
-    print("ReadBones", file.tell())
+    if DEBUG:
+        print("ReadBones", file.tell())
     count = ReadUChar(file)
     if count == 0:
-        print("No Bones")
+        if DEBUG:
+            print("No Bones")
         return
     pModelDefinition.numBones = count
     pModelDefinition.lBones = []
@@ -192,10 +197,12 @@ def ReadBones(file, pModelDefinition):
 
 
 def ReadHelpers(file, pModelDefinition):
-    print("ReadHelpers", file.tell())
+    if DEBUG:
+        print("ReadHelpers", file.tell())
     count = ReadUChar(file)
     if count == 0:
-        print("No Helpers")
+        if DEBUG:
+            print("No Helpers")
         return
     pModelDefinition.numHelpers = count
     pModelDefinition.lHelpers = []
@@ -210,10 +217,12 @@ def ReadHelpers(file, pModelDefinition):
 
 
 def ReadAnimation(file, pModelDefinition):
-    print("ReadAnimation", file.tell())
+    if DEBUG:
+        print("ReadAnimation", file.tell())
     count = ReadUChar(file)
     if count == 0:
-        print("No Animation")
+        if DEBUG:
+            print("No Animation")
         return
     pModelDefinition.pAnimation = sAnimation()
     pAnimation = pModelDefinition.pAnimation
@@ -237,21 +246,20 @@ def ReadAnimation(file, pModelDefinition):
         pNodeAnimation.szNodeName = ReadObjectName(file)
         pAnimation.pNodeAnimations.append(pNodeAnimation)
 
-    for node in range(pAnimation.numNodes):
-        for frame in range(pAnimation.numNodeFrames):
-            pNodeTransform = sNodeTransform()
-            pNodeTransform.qRot = ReadQuaternion(file)
-            pNodeTransform.vTrans = ReadSwizzledVector3(file)
-            pNodeTransform.vScale = ReadVector3(file)
-            # if frame == 0:
-            pAnimation.pNodeTransforms.append(pNodeTransform)
+    # Transforms are stored node by node with all frames of a node next to
+    # each other
+    pAnimation.pNodeTransforms = ReadNodeTransformArray(
+        file, pAnimation.numNodes * pAnimation.numNodeFrames
+    ).reshape(pAnimation.numNodes, pAnimation.numNodeFrames)
 
 
 def ReadAnimationMask(file, pModelDefinition):
-    print("ReadAnimationMask", file.tell())
+    if DEBUG:
+        print("ReadAnimationMask", file.tell())
     count = ReadUChar(file)
     if count == 0:
-        print("No Animation Mask")
+        if DEBUG:
+            print("No Animation Mask")
         return
     pAnimationMask = sAnimationMask()
     pAnimationMask.numNodes = ReadUInt(file)
@@ -267,11 +275,21 @@ def LoadModel(pszFilePath):
     if os.path.exists(pszFilePath) == False:
         return None  # could not open file
 
-    file = open(pszFilePath, mode="rb")
+    if os.path.getsize(pszFilePath) == 0:
+        return None  # empty files can't be mapped
+
+    # Map the file and parse it straight from the page cache. Everything kept
+    # is copied out while parsing, so the mapping is closed before returning;
+    # an open mapping would stop the file being overwritten on Windows.
+    with (
+        open(pszFilePath, mode="rb") as f,
+        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content,
+        memoryview(content) as buf,
+    ):
+        return ReadModel(Cursor(buf), pszFilePath)
 
-    content = file.read()
-    file.seek(0)
 
+def ReadModel(file, pszFilePath):
     fileHeader = sHeader(file)
 
     if (
@@ -293,8 +311,7 @@ def LoadModel(pszFilePath):
         return None  # version mismatch!
 
     pModelDefinition = sModelDefinition()
-    pModelDefinition.membuff = file
-    pModelDefinition.sModelName = hashlib.md5(content)
+    pModelDefinition.pszFilePath = pszFilePath
 
     #
     # read bones
@@ -315,13 +332,14 @@ def LoadModel(pszFilePath):
     #
     # read animation mask
     ReadAnimationMask(file, pModelDefinition)
-    print("pAnimationMask == None", pModelDefinition.numBones == None)
+    if DEBUG:
+        print("pAnimationMask == None", pModelDefinition.numBones == None)
 
-    print("Num bones:", pModelDefinition.numBones)
-    print("Num helpers:", pModelDefinition.numHelpers)
+        print("Num bones:", pModelDefinition.numBones)
+        print("Num helpers:", pModelDefinition.numHelpers)
 
-    print("EOF Position:", file.tell())
-    print("Actual file size:", len(content))
+        print("EOF Position:", file.tell())
+        print("Actual file size:", len(file.buf))
 
     return pModelDefinition
 
@@ -341,11 +359,11 @@ def SpawnAnimationMask(context, pModelDefinition):
     b_obj = context.object
 
     bpy.ops.object.mode_set(mode="POSE")
-    bones_to_highlight = []
+    bones_to_highlight = set()
 
     for bone in pModelDefinition.pAnimationMask.sAnimationMaskEntry:
         if bone.mask == 1:
-            bones_to_highlight.append(bone.szNodeName)
+            bones_to_highlight.add(bone.szNodeName)
 
     for pose_bone in b_obj.pose.bones:
         if pose_bone.name in bones_to_highlight:
@@ -366,7 +384,7 @@ def SpawnAnimation(context, pModelDefinition):
 
     # Build mapping from animation node names to armature bones
     anim_nodes = pModelDefinition.pAnimation.pNodeAnimations
-    armature_bone_names = [b.name for b in b_obj.data.bones]
+    armature_bone_names = {b.name for b in b_obj.data.bones}
 
     # Map animation node index -> armature bone name
     node_to_bone = {}
@@ -390,42 +408,59 @@ def SpawnAnimation(context, pModelDefinition):
     bpy.ops.object.mode_set(mode="POSE")
 
     num_frames = pModelDefinition.pAnimation.numNodeFrames
-    num_nodes = pModelDefinition.pAnimation.numNodes
-
-    for f in range(num_frames):
-        for n in range(num_nodes):
-            if n not in node_to_bone:
-                continue
-
-            bone_name = node_to_bone[n]
-            node_transform_counter = (num_frames * n) + f
 
-            loc = pModelDefinition.pAnimation.pNodeTransforms[
-                node_transform_counter
-            ].vTrans
-            rot = pModelDefinition.pAnimation.pNodeTransforms[
-                node_transform_counter
-            ].qRot
-            sca = pModelDefinition.pAnimation.pNodeTransforms[
-                node_transform_counter
-            ].vScale
+    # Swizzle the keyframes into Blender axes: quaternion (w, x, -z, y),
+    # vectors (x, -z, y)
+    transforms = pModelDefinition.pAnimation.pNodeTransforms
+    rotations = transforms["qRot"][..., (3, 0, 2, 1)] * (1, 1, -1, 1)
+    translations = transforms["vTrans"][..., (0, 2, 1)] * (1, -1, 1)
+    scales = transforms["vScale"]
+
+    # Rather than posing the armature and inserting keys frame by frame, work
+    # out every frame's basis per bone and write each channel's keyframes into
+    # the action in one go
+    if b_obj.animation_data is None:
+        b_obj.animation_data_create()
+    if b_obj.animation_data.action is None:
+        b_obj.animation_data.action = bpy.data.actions.new(b_obj.name + "Action")
+    action = b_obj.animation_data.action
+
+    frames = np.arange(num_frames, dtype=np.float32)
+    for n, bone_name in node_to_bone.items():
+        local_matrix = local_matrixes[n]
+        local_translation = local_matrix.to_translation()
 
-            loc -= local_matrixes[n].to_translation()
+        # location (3), rotation_quaternion (4), scale (3) per frame
+        channels = np.empty((num_frames, 10), dtype=np.float32)
+        for f in range(num_frames):
+            loc = Vector(translations[n, f]) - local_translation
+            rot = mathutils.Quaternion(rotations[n, f])
+            sca = Vector(scales[n, f])
 
             matrix = mathutils.Matrix.LocRotScale(loc, rot, sca)
 
-            matrix = (matrix.transposed() @ local_matrixes[n]).transposed()
+            matrix = (matrix.transposed() @ local_matrix).transposed()
 
-            b_obj.pose.bones[bone_name].matrix_basis = matrix
+            loc, rot, sca = matrix.decompose()
+            channels[f] = (*loc, *rot, *sca)
 
-        bpy.context.view_layer.update()
+        path = 'pose.bones["%s"].' % bpy.utils.escape_identifier(bone_name)
+        column = 0
+        for prop, size in (("location", 3), ("rotation_quaternion", 4), ("scale", 3)):
+            for i in range(size):
+                fcurve = action.fcurve_ensure_for_datablock(
+                    b_obj, path + prop, index=i, group_name=bone_name
+                )
+                fcurve.keyframe_points.clear()
+                fcurve.keyframe_points.add(num_frames)
+                fcurve.keyframe_points.foreach_set(
+                    "co", np.column_stack((frames, channels[:, column])).ravel()
+                )
+                fcurve.update()
+                column += 1
 
-        for n, bone_name in node_to_bone.items():
-            b_obj.pose.bones[bone_name].keyframe_insert(data_path="location", frame=f)
-            b_obj.pose.bones[bone_name].keyframe_insert(
-                data_path="rotation_quaternion", frame=f
-            )
-            b_obj.pose.bones[bone_name].keyframe_insert(data_path="scale", frame=f)
+    # Evaluate the new action once so the pose reflects it
+    context.view_layer.update()
 
     context.scene.frame_end = num_frames
     fps = 1000 / pModelDefinition.pAnimation.frameDurationMs
@@ -485,62 +520,43 @@ def SpawnModel(context, pModelDefinition):
     if pModelDefinition.pMesh != None:
         print("Spawning mesh", pModelDefinition.pMesh.szName)
         pMesh = pModelDefinition.pMesh
-        b_mesh = bpy.data.meshes.new(pModelDefinition.pMesh.szName)
-        b_obj = bpy.data.objects.new(pModelDefinition.pMesh.szName, b_mesh)
-
-        assert pModelDefinition.pMesh.uiId not in id_to_obj
-        id_to_obj[pModelDefinition.pMesh.uiId] = b_obj
-        print(pModelDefinition.pMesh.uiId)
-
-        list_faces = []
-
-        for i in range(pModelDefinition.pMesh.numIndices):
-            if i % 3 == 0:
-                faceTuple = (
-                    pModelDefinition.pMesh.pIndices[i],
-                    pModelDefinition.pMesh.pIndices[i + 1],
-                    pModelDefinition.pMesh.pIndices[i + 2],
-                )
-                list_faces.append(faceTuple)
-
-        b_mesh.from_pydata(pModelDefinition.pMesh.pVertices, [], list_faces)
+        b_mesh = bpy.data.meshes.new(pMesh.szName)
+        b_obj = bpy.data.objects.new(pMesh.szName, b_mesh)
+
+        assert pMesh.uiId not in id_to_obj
+        id_to_obj[pMesh.uiId] = b_obj
+        print(pMesh.uiId)
+
+        # Fill the mesh buffers directly; every polygon is a triangle whose
+        # loops are consecutive entries of the index buffer
+        numFaces = pMesh.numIndices // 3
+        b_mesh.vertices.add(pMesh.numVertices)
+        b_mesh.vertices.foreach_set(
+            "co", np.asarray(pMesh.pVertices, dtype=np.float32).ravel()
+        )
+        b_mesh.loops.add(pMesh.numIndices)
+        b_mesh.loops.foreach_set("vertex_index", pMesh.pIndices.astype(np.int32))
+        b_mesh.polygons.add(numFaces)
+        b_mesh.polygons.foreach_set(
+            "loop_start", np.arange(0, pMesh.numIndices, 3, dtype=np.int32)
+        )
 
-        b_mesh.update()
+        b_mesh.update(calc_edges=True)
 
-        if pModelDefinition.pMesh.pColors != None:
+        if pMesh.pColors is not None:
             b_mesh.vertex_colors.new()
 
+        # The loops' vertex_index was set straight from pIndices, so per-loop
+        # data is a gather of the per-vertex arrays through pIndices
         uvlayer = b_obj.data.uv_layers.new()
-        uv_count = 0
-
-        for i in range(0, pModelDefinition.pMesh.numIndices, 3):
-            uvlayer.data[uv_count].uv = pModelDefinition.pMesh.pTexCoords[
-                pModelDefinition.pMesh.pIndices[i]
-            ]
-            uvlayer.data[uv_count + 1].uv = pModelDefinition.pMesh.pTexCoords[
-                pModelDefinition.pMesh.pIndices[i + 1]
-            ]
-            uvlayer.data[uv_count + 2].uv = pModelDefinition.pMesh.pTexCoords[
-                pModelDefinition.pMesh.pIndices[i + 2]
-            ]
-            if pModelDefinition.pMesh.pColors != None:
-                b_obj.data.vertex_colors[0].data[
-                    uv_count
-                ].color = pModelDefinition.pMesh.pColors[
-                    pModelDefinition.pMesh.pIndices[i]
-                ]
-                b_obj.data.vertex_colors[0].data[
-                    uv_count + 1
-                ].color = pModelDefinition.pMesh.pColors[
-                    pModelDefinition.pMesh.pIndices[i + 1]
-                ]
-                b_obj.data.vertex_colors[0].data[
-                    uv_count + 2
-                ].color = pModelDefinition.pMesh.pColors[
-                    pModelDefinition.pMesh.pIndices[i + 2]
-                ]
-
-            uv_count += 3
+        if pMesh.pTexCoords:
+            uvlayer.data.foreach_set(
+                "uv", pMesh.pTexCoords[0][pMesh.pIndices].astype(np.float32).ravel()
+            )
+        if pMesh.pColors is not None:
+            b_obj.data.vertex_colors[0].data.foreach_set(
+                "color", pMesh.pColors[pMesh.pIndices].astype(np.float32).ravel()
+            )
         # Build combined list of all skinnable objects (bones + helpers) indexed by their ID
         skin_targets = {}  # id -> name mapping
 
@@ -557,36 +573,38 @@ def SpawnModel(context, pModelDefinition):
                 b_obj.vertex_groups.new(name=vg_name)
                 skin_targets[helper.uiId] = vg_name
 
-        if pMesh.pSkinBoneIndices != None:
+        if pMesh.pSkinBoneIndices is not None:
+            # Influences below the threshold are ignored
+            influential = pMesh.pSkinWeights >= 0.0001
+            vert_ids = np.nonzero(influential)[0].tolist()
+            bone_ids = pMesh.pSkinBoneIndices[influential].tolist()
+            weights = pMesh.pSkinWeights[influential].tolist()
+
             # First pass: find all bone IDs referenced in skin data
-            for i in range(len(pMesh.pSkinBoneIndices)):
-                for v in range(0, 4):
-                    bone_idx = pMesh.pSkinBoneIndices[i][v]
-                    weight = pMesh.pSkinWeights[i][v]
-                    if weight >= 0.0001 and bone_idx not in skin_targets:
-                        # Create a placeholder vertex group for unknown bone IDs
-                        vg_name = f"Bone_{bone_idx}"
-                        b_obj.vertex_groups.new(name=vg_name)
-                        skin_targets[bone_idx] = vg_name
-                        print(f"[Warning] Created placeholder vertex group '{vg_name}' for unknown bone ID {bone_idx}")
-
-            # Second pass: assign weights
-            for i in range(len(pMesh.pSkinBoneIndices)):
-                for v in range(0, 4):
-                    bone_idx = pMesh.pSkinBoneIndices[i][v]
-                    weight = pMesh.pSkinWeights[i][v]
-
-                    if weight < 0.0001:
-                        continue
-
-                    vertex_group_name = skin_targets.get(bone_idx)
-                    if vertex_group_name is None:
-                        continue
-
-                    vertex_group = b_obj.vertex_groups.get(vertex_group_name)
-                    if vertex_group is None:
-                        continue
-                    vertex_group.add([i], weight, "ADD")
+            for bone_idx in dict.fromkeys(bone_ids):
+                if bone_idx not in skin_targets:
+                    # Create a placeholder vertex group for unknown bone IDs
+                    vg_name = f"Bone_{bone_idx}"
+                    b_obj.vertex_groups.new(name=vg_name)
+                    skin_targets[bone_idx] = vg_name
+                    print(f"[Warning] Created placeholder vertex group '{vg_name}' for unknown bone ID {bone_idx}")
+
+            # Second pass: bucket vertices sharing a bone and weight so each
+            # bucket is assigned with a single vertex_group.add call
+            buckets = {}
+            for i, bone_idx, weight in zip(vert_ids, bone_ids, weights):
+                buckets.setdefault((bone_idx, weight), []).append(i)
+
+            vertex_groups = b_obj.vertex_groups
+            for (bone_idx, weight), indices in buckets.items():
+                vertex_group_name = skin_targets.get(bone_idx)
+                if vertex_group_name is None:
+                    continue
+
+                vertex_group = vertex_groups.get(vertex_group_name)
+                if vertex_group is None:
+                    continue
+                vertex_group.add(indices, weight, "ADD")
 
         b_mesh.update(calc_edges=True)
         context.view_layer.active_layer_collection.collection.objects.link(b_obj)
@@ -598,7 +616,7 @@ def SpawnModel(context, pModelDefinition):
         # bpy.ops.mesh.select_all(action='DESELECT')
         # bpy.ops.object.mode_set(mode='OBJECT')
 
-        for collision in pModelDefinition.pMesh.pCollisions:
+        for collision in pMesh.pCollisions:
             print(
                 "Spawning collision",
                 sCollisionShape.eCollisionType[collision.collisionType],
@@ -610,9 +628,9 @@ def SpawnModel(context, pModelDefinition):
                 col_obj.name = "COL_SPHERE"
                 col_obj.matrix_world = collision.transform
                 col_obj.scale = (
-                    collision.sphere.radius,
-                    collision.sphere.radius,
-                    collision.sphere.radius,
+                    collision.radius,
+                    collision.radius,
+                    collision.radius,
                 )
 
             elif collision.collisionType == 1:  # Box
@@ -625,7 +643,7 @@ def SpawnModel(context, pModelDefinition):
 
                 col_obj.name = "COL_BOX"
                 col_obj.matrix_world = collision.transform
-                col_obj.scale = collision.box.extents
+                col_obj.scale = collision.extents
 
             elif collision.collisionType == 2:  # Capsule
                 bpy.ops.mesh.primitive_cylinder_add()
@@ -634,9 +652,9 @@ def SpawnModel(context, pModelDefinition):
                 col_obj.matrix_world = collision.transform
                 # Since we spawn a cylinder rather than a capsule, adjust for the extra height with 0.2488
                 col_obj.scale = (
-                    collision.capsule.radius,
-                    collision.capsule.radius,
-                    collision.capsule.halfHeight + 0.2488,
+                    collision.radius,
+                    collision.radius,
+                    collision.halfHeight + 0.2488,
                 )
                 bpy.ops.object.mode_set(mode="EDIT")
                 bpy.ops.mesh.select_all(action="SELECT")
@@ -672,13 +690,14 @@ def SpawnModel(context, pModelDefinition):
     bpy.ops.object.mode_set(mode="OBJECT")
 
     if pModelDefinition.lBones != None:
-        for bone in pModelDefinition.lBones:  # parent the bones
+        # Parent and place the bones in one pass. Edit bone matrices are in
+        # armature space, so the order within the list doesn't matter
+        for bone in pModelDefinition.lBones:
+            bone_obj = id_to_obj[bone.uiId]
             if bone.uiParentId != -1:
                 assert bone.uiParentId in id_to_obj
-                id_to_obj[bone.uiId].parent = id_to_obj[bone.uiParentId]
-
-        for bone in pModelDefinition.lBones:
-            id_to_obj[bone.uiId].matrix = bone.matGlobal
+                bone_obj.parent = id_to_obj[bone.uiParentId]
+            bone_obj.matrix = bone.matGlobal
 
         # for bone in pModelDefinition.lBones:
         #     if bone.uiParentId != -1:
@@ -719,9 +738,8 @@ def load(
     global_matrix=None,
 ):
     pModelDefinition = LoadModel(filepath)
-    # file = open("H:\\DK2\\importjson.json", "w+")
-    # file.write(json.dumps(pModelDefinition.toJSON(), sort_keys=True, indent=4))
-    # file.close()
+    # with open("H:\\DK2\\importjson.json", "w") as file:
+    #     pModelDefinition.writeJSON(file)
 
     if pModelDefinition.pMesh != None:
         SpawnModel(context, pModelDefinition)
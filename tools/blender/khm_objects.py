@@ -1,3 +1,10 @@
+import hashlib
+import json
+from collections.abc import Iterator
+
+import numpy as np
+from numpy.lib.recfunctions import structured_to_unstructured
+
 from .binary_io import *
 
 KHM_VERSION = 101
@@ -6,17 +13,36 @@ KHM_MAX_BONE_INFLUENCES = 4
 KHM_MAX_BONES = 64
 
 
-class sCollisionPolygon:
-    def __init__(self, file):
-        self.normal = ReadVector3(file)  # normal, -d
-        self.d = ReadFloat(file)
-        self.numIndices = ReadShort(file)
-        self.indexStart = ReadShort(file)
+def arrayToJSON(value):
+    # Debug dumps only; nested lists of numbers, which json encodes natively
+    if value is None:
+        return None
+    return np.asarray(value).tolist()
+
+
+def matrixToJSON(name, matrix):
+    # The matrix plus its decomposition, decomposed once
+    pos, rot, sca = matrix.decompose()
+    return {
+        name: arrayToJSON(matrix),
+        name + "Position": arrayToJSON(pos),
+        name + "Rotation": arrayToJSON(rot),
+        name + "Scale": arrayToJSON(sca),
+    }
 
 
 class sCollisionMesh:
+    __slots__ = (
+        "pPolygons",
+        "pIndices",
+        "pVertices",
+        "numPolys",
+        "numIndices",
+        "numVertices",
+    )
+
     def __init__(self):
-        self.pPolygons = None
+        self.pPolygons = None  # COLLISION_POLYGON_DTYPE records
         self.pIndices = None
         self.pVertices = None
         self.numPolys = 0
@@ -24,38 +50,31 @@ class sCollisionMesh:
         self.numVertices = 0
 
 
-class Sphere:
-    def __init__(self, radius):
-        self.radius = radius
-
-
-class Box:
-    def __init__(self, extents):
-        self.extents = extents
-
-
-class Capsule:
-    def __init__(self, radius, halfHeight):
-        self.radius = radius
-        self.halfHeight = halfHeight  # elongates the sphere defined by 'radius' on the X axis. If zero, it's a sphere. (see PhysX manual)
-
-
-# planes default on +X orientation normal=(1,0,0). Rotate/displace using the collision transform
-class Plane:
-    def __init__(self):
-        pass
-
-
 class sCollisionShape:
-    eCollisionType = {
-        0: "SPHERE",
-        1: "BOX",
-        2: "CAPSULE",
-        3: "CONVEX_MESH",  # triangle mesh, assumes concave. Will be cooked into a convex shape at runtime.
-        4: "MESH",
-        5: "PLANE",
-    }
-
+    # Names indexed by collisionType
+    eCollisionType = (
+        "SPHERE",
+        "BOX",
+        "CAPSULE",
+        "CONVEX_MESH",  # triangle mesh, assumes concave. Will be cooked into a convex shape at runtime.
+        "MESH",
+        "PLANE",
+    )
+
+    __slots__ = (
+        "collisionType",
+        "transform",
+        "bShared",
+        "radius",
+        "halfHeight",
+        "extents",
+        "mesh",
+    )
+
+    # The shape parameters are stored inline, like a union in the engine:
+    # SPHERE uses radius, CAPSULE radius and halfHeight, BOX extents. Planes
+    # have no parameters and default on +X orientation normal=(1,0,0); they
+    # are rotated/displaced using the collision transform.
     def __init__(self):
         # self.collisionType = "SPHERE"
         self.bShared = False
@@ -65,52 +84,54 @@ class sCollisionShape:
 
     def setSphere(self, radius):
         # self.collisionType = "SPHERE"
-        self.sphere = Sphere(radius)
-        self.box = None
-        self.capsule = None
-        self.plane = None
+        self.radius = radius
+        self.halfHeight = 0.0
+        self.extents = None
 
     def setBox(self, extents):
         # self.collisionType = "BOX"
-        self.box = Box(extents)
-        self.sphere = None
-        self.capsule = None
-        self.plane = None
+        self.radius = 0.0
+        self.halfHeight = 0.0
+        self.extents = extents
 
     def setCapsule(self, radius, halfHeight):
         # self.collisionType = "CAPSULE"
-        self.capsule = Capsule(radius, halfHeight)
-        self.sphere = None
-        self.box = None
-        self.plane = None
+        self.radius = radius
+        # elongates the sphere defined by 'radius' on the X axis. If zero, it's a sphere. (see PhysX manual)
+        self.halfHeight = halfHeight
+        self.extents = None
 
     def setConvexMesh(self):
         # self.collisionType = "CONVEX_MESH"
-        self.sphere = None
-        self.box = None
-        self.capsule = None
-        self.plane = None
+        self.radius = 0.0
+        self.halfHeight = 0.0
+        self.extents = None
 
     def GetVolume(self):  # TODO
         return 0.0
 
     def toJSON(self):
-        dictionary = {}
-        dictionary["collisionType"] = self.eCollisionType[self.collisionType]
-        dictionary["transform_matrix"] = str(self.transform)
-        dictionary["transform_pos"] = str(self.transform.to_translation())
-        dictionary["transform_rot"] = str(self.transform.to_quaternion())
-        dictionary["transform_sca"] = str(self.transform.to_scale())
-        if self.eCollisionType[self.collisionType] == "BOX":
-            dictionary["extents"] = str(self.box.extents)
-        elif self.eCollisionType[self.collisionType] == "CAPSULE":
-            dictionary["radius"] = str(self.capsule.radius)
-            dictionary["halfHeight"] = str(self.capsule.halfHeight)
+        collisionType = self.collisionType
+        pos, rot, sca = self.transform.decompose()
+        dictionary = {
+            "collisionType": self.eCollisionType[collisionType],
+            "transform_matrix": arrayToJSON(self.transform),
+            "transform_pos": arrayToJSON(pos),
+            "transform_rot": arrayToJSON(rot),
+            "transform_sca": arrayToJSON(sca),
+        }
+        if collisionType == 1:  # BOX
+            dictionary["extents"] = arrayToJSON(self.extents)
+        elif collisionType == 2:  # CAPSULE
+            dictionary["radius"] = self.radius
+            dictionary["halfHeight"] = self.halfHeight
 
         return dictionary
 
 
 class sObjectBase:
+    __slots__ = ("szName", "uiId", "uiParentId", "matLocal", "matGlobal")
+
     def __init__(self):
         self.szName = ""
         self.uiId = 0
@@ -119,34 +140,49 @@ class sObjectBase:
         self.matGlobal = None
 
     def toJSON(self):
-        dictionary = {}
-        dictionary["szName"] = self.szName
-        dictionary["uiId"] = self.uiId
-        dictionary["uiParentId"] = self.uiParentId
-        dictionary["matLocal"] = str(self.matLocal)
-        dictionary["matLocalPosition"] = str(self.matLocal.to_translation())
-        dictionary["matLocalRotation"] = str(self.matLocal.to_quaternion())
-        dictionary["matLocalScale"] = str(self.matLocal.to_scale())
-        dictionary["matGlobal"] = str(self.matGlobal)
-        dictionary["matGlobalPosition"] = str(self.matGlobal.to_translation())
-        dictionary["matGlobalRotation"] = str(self.matGlobal.to_quaternion())
-        dictionary["matGlobalScale"] = str(self.matGlobal.to_scale())
-        return dictionary
+        return {
+            "szName": self.szName,
+            "uiId": self.uiId,
+            "uiParentId": self.uiParentId,
+            **matrixToJSON("matLocal", self.matLocal),
+            **matrixToJSON("matGlobal", self.matGlobal),
+        }
 
 
 class sObjectMesh(sObjectBase):
+    __slots__ = (
+        "numVertices",
+        "pVertices",
+        "pNormals",
+        "pColors",
+        "numTxCoordMaps",
+        "pTexCoords",
+        "pSkinWeights",
+        "pSkinBoneIndices",
+        "numIndices",
+        "pIndices",
+        "pFaceNormals",
+        "numCollisions",
+        "pCollisions",
+        "min",
+        "max",
+        "volume",
+    )
+
     def __init__(self):
+        # Per-vertex channels are kept as separate numpy arrays so each can
+        # be read and written in bulk
         self.numVertices = 0
-        self.pVertices = None
-        self.pNormals = None
-        self.pColors = None
+        self.pVertices = None  # (numVertices, 3) float32
+        self.pNormals = None  # (numVertices, 3) float32
+        self.pColors = None  # (numVertices, 4) float, 0..1
         self.numTxCoordMaps = 0
-        self.pTexCoords = [None, None]
-        self.pSkinWeights = None
-        self.pSkinBoneIndices = None
+        self.pTexCoords = []  # one (numVertices, 2) array per map
+        self.pSkinWeights = None  # (numVertices, 4) float32
+        self.pSkinBoneIndices = None  # (numVertices, 4) uint8
         self.numIndices = 0
-        self.pIndices = None
-        self.pFaceNormals = None
+        self.pIndices = None  # (numIndices,) uint16
+        self.pFaceNormals = None  # (numIndices / 3, 3) float32
         self.numCollisions = 0
         self.pCollisions = None
         self.min = None
@@ -154,45 +190,36 @@ class sObjectMesh(sObjectBase):
         self.volume = 0.0
 
     def toJSON(self):
-        print("NUM COLLISIONS", self.numCollisions)
-        print("LEN COLLISIONS", len(self.pCollisions))
-        dictionary = {}
-        dictionary["szName"] = self.szName
-        dictionary["uiId"] = self.uiId
-        dictionary["uiParentId"] = self.uiParentId
-        dictionary["matLocal"] = str(self.matLocal)
-        dictionary["matGlobal"] = str(self.matGlobal)
-        dictionary["matGlobalPosition"] = str(self.matGlobal.to_translation())
-        dictionary["matGlobalRotation"] = str(self.matGlobal.to_quaternion())
-        dictionary["matGlobalScale"] = str(self.matGlobal.to_scale())
-
-        dictionary["numVertices"] = self.numVertices
-        dictionary["pVertices"] = vector3ArrayToString(self.pVertices)
-        dictionary["pNormals"] = vector3ArrayToString(self.pNormals)
-        dictionary["pColors"] = vector4ArrayToString(self.pColors)
-        dictionary["numTxCoordMaps"] = self.numTxCoordMaps
-        dictionary["pTexCoords"] = vector2ArrayToString(self.pTexCoords)
-        dictionary["pSkinWeights"] = skinWeightsToString(self.pSkinWeights)
-        dictionary["pSkinBoneIndices"] = self.pSkinBoneIndices
-        dictionary["numIndices"] = self.numIndices
-        dictionary["pIndices"] = self.pIndices
-        dictionary["pFaceNormals"] = vector3ArrayToString(self.pFaceNormals)
-
-        dictionary["numCollisions"] = self.numCollisions
-
-        dictionary["pCollisions"] = []
-        if self.pCollisions != None:
-            for collision in self.pCollisions:
-                dictionary["pCollisions"].append(collision.toJSON())
-        dictionary["min"] = vector3ToString(self.min)
-        dictionary["max"] = vector3ToString(self.max)
-        dictionary["volume"] = self.volume
-        return dictionary
+        return {
+            "szName": self.szName,
+            "uiId": self.uiId,
+            "uiParentId": self.uiParentId,
+            "matLocal": arrayToJSON(self.matLocal),
+            **matrixToJSON("matGlobal", self.matGlobal),
+            "numVertices": self.numVertices,
+            "pVertices": arrayToJSON(self.pVertices),
+            "pNormals": arrayToJSON(self.pNormals),
+            "pColors": arrayToJSON(self.pColors),
+            "numTxCoordMaps": self.numTxCoordMaps,
+            "pTexCoords": arrayToJSON(self.pTexCoords),
+            "pSkinWeights": arrayToJSON(self.pSkinWeights),
+            "pSkinBoneIndices": arrayToJSON(self.pSkinBoneIndices),
+            "numIndices": self.numIndices,
+            "pIndices": arrayToJSON(self.pIndices),
+            "pFaceNormals": arrayToJSON(self.pFaceNormals),
+            "numCollisions": self.numCollisions,
+            "pCollisions": [
+                collision.toJSON() for collision in self.pCollisions or ()
+            ],
+            "min": arrayToJSON(self.min),
+            "max": arrayToJSON(self.max),
+            "volume": self.volume,
+        }
 
 
 class sHeader:
     def __init__(self, file):
-        self.uiSig = file.read(4)
+        self.uiSig = bytes(file.read(4))
         self.uiVer = ReadUInt(file)
 
     def export(file):
@@ -201,15 +228,14 @@ class sHeader:
 
 
 class sAnimationMaskEntry:
+    __slots__ = ("mask", "szNodeName")
+
     def __init__(self):
         self.mask = 0
         self.szNodeName = ""
 
     def toJSON(self):
-        dictionary = {}
-        dictionary["mask"] = self.mask
-        dictionary["szNodeName"] = self.szNodeName
-        return dictionary
+        return {"mask": self.mask, "szNodeName": self.szNodeName}
 
 
 class sAnimationMask:
@@ -218,37 +244,31 @@ class sAnimationMask:
         self.numNodes = 0
 
     def toJSON(self):
-        dictionary = {}
-        dictionary["numNodes"] = self.numNodes
-        dictionary["sAnimationMaskEntry"] = []
-        for animationMaskEntry in self.sAnimationMaskEntry:
-            dictionary["sAnimationMaskEntry"].append(animationMaskEntry.toJSON())
-        return dictionary
-
-
-class sNodeTransform:
-    def __init__(self):
-        self.qRot = None  # quaternion
-        self.vTrans = None
-        self.vScale = None
+        return {
+            "numNodes": self.numNodes,
+            "sAnimationMaskEntry": [
+                animationMaskEntry.toJSON()
+                for animationMaskEntry in self.sAnimationMaskEntry
+            ],
+        }
 
 
 class sNodeAnimation:
+    __slots__ = ("uiNodeId", "szNodeName")
+
     def __init__(self):
         self.uiNodeId = 0
         self.szNodeName = ""
 
     def toJSON(self):
-        dictionary = {}
-        dictionary["uiNodeId"] = self.uiNodeId
-        dictionary["szNodeName"] = self.szNodeName
-        return dictionary
+        return {"uiNodeId": self.uiNodeId, "szNodeName": self.szNodeName}
 
 
 class sAnimation:
     def __init__(self):
         self.pNodeAnimations = []
-        self.pNodeTransforms = []
+        # (numNodes, numNodeFrames) array of NODE_TRANSFORM_DTYPE records
+        self.pNodeTransforms = np.empty((0, 0), dtype=NODE_TRANSFORM_DTYPE)
         self.numNodes = 0
         self.numNodeFrames = 0
         self.frameDurationMs = 0.0
@@ -256,33 +276,20 @@ class sAnimation:
         self.endTimeS = 0.0
 
     def toJSON(self):
-        dictionary = {}
-        dictionary["numNodes"] = self.numNodes
-        dictionary["numNodeFrames"] = self.numNodeFrames
-        dictionary["frameDurationMs"] = self.frameDurationMs
-        dictionary["pNodeTransforms"] = []
-        dictionary["startTimeS"] = self.startTimeS
-        dictionary["endTimeS"] = self.endTimeS
-        # for node in range(self.numNodes):
-        #    for frame in range(self.numNodeFrames):
-        #        dictionary["pNodeTransforms"].append("a")
-
-        print("length: ", len(self.pNodeTransforms))
-        for node in range(self.numNodes):
-            transforms = []
-            for frame in range(self.numNodeFrames - 1):
-                index = (self.numNodeFrames * node) + frame
-                print("index", index)
-                transforms.append(pNodeTransformToString(self.pNodeTransforms[index]))
-
-            dictionary["pNodeTransforms"].append(transforms)
-
-        # dictionary["pNodeAnimations"] = []
-        # for anim in self.pNodeAnimations:
-        #    dictionary["pNodeAnimations"].append(anim.toJSON())
-        # for transform in self.pNodeTransforms:
-        #    dictionary["pNodeTransforms"].append(pNodeTransformToString(transform))
-        return dictionary
+        # Per node, one flat [qRot(4), vTrans(3), vScale(3)] list per frame
+        transforms = structured_to_unstructured(self.pNodeTransforms)
+        return {
+            "numNodes": self.numNodes,
+            "numNodeFrames": self.numNodeFrames,
+            "frameDurationMs": self.frameDurationMs,
+            "startTimeS": self.startTimeS,
+            "endTimeS": self.endTimeS,
+            "pNodeTransforms": [
+                transforms[node, : self.numNodeFrames - 1].tolist()
+                for node in range(self.numNodes)
+            ],
+            # "pNodeAnimations": [anim.toJSON() for anim in self.pNodeAnimations],
+        }
 
 
 class sModelDefinition:
@@ -294,7 +301,17 @@ class sModelDefinition:
         self.lBones = None
         self.pAnimation = None
         self.pAnimationMask = None
-        self.membuff = None
+        self.bone_local_matrices = None
+        self.pszFilePath = None
+        self._sModelName = None
+
+    @property
+    def sModelName(self):
+        # md5 of the loaded file, only hashed when something asks for it
+        if self._sModelName is None and self.pszFilePath is not None:
+            with open(self.pszFilePath, "rb") as f:
+                self._sModelName = hashlib.file_digest(f, "md5").hexdigest()
+        return self._sModelName
 
     def GetObjectById(self, uiId):
         pass
@@ -302,24 +319,43 @@ class sModelDefinition:
     def GetObjectByName(self, pszName):
         pass
 
-    def toJSON(self):
-        dictionary = {}
+    def iterJSON(self):
+        # (key, value) pairs, each value built only when it's reached. Helpers
+        # and bones are yielded as generators of their entries.
         if self.pMesh != None:
-            dictionary["pMesh"] = self.pMesh.toJSON()
+            yield "pMesh", self.pMesh.toJSON()
         else:
-            dictionary["pMesh"] = None
-        dictionary["numHelpers"] = self.numHelpers
-        dictionary["Helpers"] = []
-        if self.lHelpers != None:
-            for helper in self.lHelpers:
-                dictionary["Helpers"].append(helper.toJSON())
-        dictionary["numBones"] = self.numBones
-        dictionary["lBones"] = []
-        if self.lBones != None:
-            for bone in self.lBones:
-                dictionary["lBones"].append(bone.toJSON())
+            yield "pMesh", None
+        yield "numHelpers", self.numHelpers
+        yield "Helpers", (helper.toJSON() for helper in self.lHelpers or ())
+        yield "numBones", self.numBones
+        yield "lBones", (bone.toJSON() for bone in self.lBones or ())
         if self.pAnimation != None:
-            dictionary["pAnimation"] = self.pAnimation.toJSON()
+            yield "pAnimation", self.pAnimation.toJSON()
         if self.pAnimationMask != None:
-            dictionary["pAnimationMask"] = self.pAnimationMask.toJSON()
+            yield "pAnimationMask", self.pAnimationMask.toJSON()
+
+    def toJSON(self):
+        dictionary = {}
+        for key, value in self.iterJSON():
+            dictionary[key] = list(value) if isinstance(value, Iterator) else value
         return dictionary
+
+    def writeJSON(self, file):
+        # Stream the dump one entry at a time, so only the entry being written
+        # is held in memory rather than the whole model's dictionary
+        file.write("{")
+        for i, (key, value) in enumerate(self.iterJSON()):
+            if i:
+                file.write(", ")
+            file.write(json.dumps(key) + ": ")
+            if isinstance(value, Iterator):
+                file.write("[")
+                for j, entry in enumerate(value):
+                    if j:
+                        file.write(", ")
+                    json.dump(entry, file)
+                file.write("]")
+            else:
+                json.dump(value, file)
+        file.write("}")
@@ -20,6 +20,9 @@ import bpy
 SCRIPT_DIR = Path(__file__).parent
 OUTPUT_DIR = SCRIPT_DIR / "output"
 
+# Vertex groups for KHM helpers carry this prefix and are always kept
+HELPER_PREFIX = "HELPER_"
+
 
 def get_args():
     """Parse command line arguments."""
@@ -46,25 +49,28 @@ def get_args():
     return blend_path, reference_khm
 
 
-def cleanup_existing_armatures_and_collisions():
+def bucket_objects():
+    """Sort scene objects into armatures, collision meshes and other meshes."""
+    buckets = {"ARMATURE": [], "COL": [], "MESH": []}
+    for obj in bpy.data.objects:
+        if obj.type == "ARMATURE":
+            buckets["ARMATURE"].append(obj)
+        elif obj.type == "MESH":
+            buckets["COL" if "COL_" in obj.name else "MESH"].append(obj)
+    return buckets
+
+
+def cleanup_existing_armatures_and_collisions(buckets):
     """Remove any existing armatures and collision meshes from the scene."""
-    armatures = [obj for obj in bpy.data.objects if obj.type == "ARMATURE"]
-    collisions = [
-        obj for obj in bpy.data.objects if obj.type == "MESH" and "COL_" in obj.name
-    ]
+    armatures = buckets["ARMATURE"]
+    collisions = buckets["COL"]
 
-    for arm in armatures:
-        bpy.data.objects.remove(arm, do_unlink=True)
-    for col in collisions:
-        bpy.data.objects.remove(col, do_unlink=True)
+    # Remove from the end so the collection doesn't reindex on every removal
+    for obj in reversed(armatures + collisions):
+        bpy.data.objects.remove(obj, do_unlink=True)
 
-    # Clean up orphan data
-    for arm_data in bpy.data.armatures:
-        if arm_data.users == 0:
-            bpy.data.armatures.remove(arm_data)
-    for mesh_data in bpy.data.meshes:
-        if mesh_data.users == 0:
-            bpy.data.meshes.remove(mesh_data)
+    # Clean up orphan data (including the armature and mesh data left behind)
+    bpy.data.orphans_purge(do_local_ids=True)
 
     if armatures:
         print(f"Removed {len(armatures)} existing armature(s)")
@@ -72,10 +78,10 @@ def cleanup_existing_armatures_and_collisions():
         print(f"Removed {len(collisions)} existing collision mesh(es)")
 
 
-def import_khm_armature_and_mesh(khm_path, target_mesh_name):
+def import_khm_armature_and_mesh(khm_path, target_mesh_name, buckets):
     """Import a KHM file and return armature, source mesh, and collision mesh."""
     # Clean up any existing armatures and collisions first
-    cleanup_existing_armatures_and_collisions()
+    cleanup_existing_armatures_and_collisions(buckets)
 
     # Enable khm_tools addon
     addon_utils.enable("khm_tools")
@@ -84,18 +90,23 @@ def import_khm_armature_and_mesh(khm_path, target_mesh_name):
     import_op = getattr(bpy.ops.khm, "import")
     import_op(filepath=khm_path)
 
-    # Find the imported armature and mesh
+    # Find the imported armature and mesh. The last match of each kind wins,
+    # so scan backwards and stop once all three are found
     armature = None
     source_mesh = None
     collision_mesh = None
-    for obj in bpy.data.objects:
+    for obj in reversed(bpy.data.objects):
         if obj.type == "ARMATURE":
-            armature = obj
+            if armature is None:
+                armature = obj
         elif obj.type == "MESH" and obj.name != target_mesh_name:
             if "COL_" in obj.name:
-                collision_mesh = obj
-            else:
+                if collision_mesh is None:
+                    collision_mesh = obj
+            elif source_mesh is None:
                 source_mesh = obj
+        if armature and source_mesh and collision_mesh:
+            break
 
     if not armature:
         raise ValueError("No armature found in KHM file")
@@ -113,19 +124,31 @@ def import_khm_armature_and_mesh(khm_path, target_mesh_name):
     return armature, source_mesh, collision_mesh
 
 
+def select_only(objects, active):
+    """Make objects the whole selection and active the active object."""
+    # Only the currently selected objects need touching, unlike select_all
+    for obj in bpy.context.selected_objects:
+        obj.select_set(False)
+    for obj in objects:
+        obj.select_set(True)
+    bpy.context.view_layer.objects.active = active
+
+
 def transfer_weights_data_transfer(target_mesh, source_mesh, armature):
     """Transfer weights using Blender's Data Transfer modifier."""
-    # First, parent target to armature with empty vertex groups
-    bpy.ops.object.select_all(action="DESELECT")
-    target_mesh.select_set(True)
-    armature.select_set(True)
-    bpy.context.view_layer.objects.active = armature
-    bpy.ops.object.parent_set(type="ARMATURE_NAME")
+    # First, parent target to armature with empty vertex groups. This is what
+    # parent_set(type="ARMATURE_NAME") does, without the operator overhead
+    target_mesh.parent = armature
+    target_mesh.matrix_parent_inverse = armature.matrix_world.inverted()
+    # Named like the operator names it, for anything looking it up by name
+    arm_mod = target_mesh.modifiers.new(name="Armature", type="ARMATURE")
+    arm_mod.object = armature
+    for bone in armature.data.bones:
+        if bone.use_deform and bone.name not in target_mesh.vertex_groups:
+            target_mesh.vertex_groups.new(name=bone.name)
 
     # Select target mesh
-    bpy.ops.object.select_all(action="DESELECT")
-    target_mesh.select_set(True)
-    bpy.context.view_layer.objects.active = target_mesh
+    select_only((target_mesh,), target_mesh)
 
     # Add Data Transfer modifier
     mod = target_mesh.modifiers.new(name="DataTransfer", type="DATA_TRANSFER")
@@ -141,19 +164,22 @@ def transfer_weights_data_transfer(target_mesh, source_mesh, armature):
     return True
 
 
-def clean_vertex_groups(mesh, armature):
+def bone_name_set(armature):
+    """Collect the armature's bone names once for membership tests."""
+    return frozenset(bone.name for bone in armature.data.bones)
+
+
+def clean_vertex_groups(mesh, bone_names):
     """Remove vertex groups that don't correspond to bones."""
-    bone_names = set(bone.name for bone in armature.data.bones)
 
-    groups_to_remove = []
-    for vg in mesh.vertex_groups:
-        if vg.name not in bone_names and not vg.name.startswith("HELPER_"):
-            groups_to_remove.append(vg.name)
+    groups_to_remove = [
+        vg
+        for vg in mesh.vertex_groups
+        if vg.name not in bone_names and not vg.name.startswith(HELPER_PREFIX)
+    ]
 
-    for name in groups_to_remove:
-        vg = mesh.vertex_groups.get(name)
-        if vg:
-            mesh.vertex_groups.remove(vg)
+    for vg in groups_to_remove:
+        mesh.vertex_groups.remove(vg)
 
     if groups_to_remove:
         print(f"Removed {len(groups_to_remove)} unused vertex groups")
@@ -173,11 +199,8 @@ def main():
     bpy.ops.wm.open_mainfile(filepath=blend_path)
 
     # Find the target mesh (skip collision meshes)
-    mesh = None
-    for obj in bpy.data.objects:
-        if obj.type == "MESH" and "COL_" not in obj.name:
-            mesh = obj
-            break
+    buckets = bucket_objects()
+    mesh = buckets["MESH"][0] if buckets["MESH"] else None
 
     if not mesh:
         raise ValueError("No mesh found in blend file")
@@ -187,7 +210,7 @@ def main():
     # Import armature and source mesh from reference KHM
     print(f"\nImporting armature from {reference_khm}...")
     armature, source_mesh, collision_mesh = import_khm_armature_and_mesh(
-        reference_khm, mesh.name
+        reference_khm, mesh.name, buckets
     )
 
     if source_mesh:
@@ -209,7 +232,7 @@ def main():
         print(f"Parented {collision_mesh.name} to {mesh.name}")
 
     # Clean up vertex groups
-    clean_vertex_groups(mesh, armature)
+    clean_vertex_groups(mesh, bone_name_set(armature))
 
     # Save the file
     bpy.ops.wm.save_mainfile()
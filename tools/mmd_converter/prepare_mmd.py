@@ -12,14 +12,23 @@ This script prepares MMD (PMX) models for use in Door Kickers 2 by:
 8. Replacing materials with the baked texture
 """
 
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import bpy
+import numpy as np
 
 # Configuration
 TARGET_HEIGHT = 1.92  # metres
 MAX_FACES = 40000
 TEXTURE_SIZE = 4096
+BAKE_MARGIN = 16  # pixels
+TEXTURE_SEARCH_THREADS = 8
+# Stripped from PMX filenames to get the model name
+NAME_PREFIX_RE = re.compile(r"^GirlsFrontline[ _]")
+NAME_SUFFIX_RE = re.compile(r"Default$")
 
 # Get the script's directory for output
 SCRIPT_DIR = Path(__file__).parent
@@ -50,14 +59,8 @@ def get_model_name(pmx_path):
             return sys.argv[i + 1]
 
     # Default: use PMX filename without extension, cleaned up
-    name = Path(pmx_path).stem
-    # Remove common prefixes
-    for prefix in ["GirlsFrontline ", "GirlsFrontline_"]:
-        if name.startswith(prefix):
-            name = name[len(prefix) :]
-    # Remove "Default" suffix
-    if name.endswith("Default"):
-        name = name[:-7]
+    # Remove common prefixes and the "Default" suffix
+    name = NAME_SUFFIX_RE.sub("", NAME_PREFIX_RE.sub("", Path(pmx_path).stem))
     return name.lower().replace(" ", "_")
 
 
@@ -66,19 +69,9 @@ def clear_scene():
     bpy.ops.object.select_all(action="SELECT")
     bpy.ops.object.delete()
 
-    # Clear orphan data
-    for block in bpy.data.meshes:
-        if block.users == 0:
-            bpy.data.meshes.remove(block)
-    for block in bpy.data.materials:
-        if block.users == 0:
-            bpy.data.materials.remove(block)
-    for block in bpy.data.textures:
-        if block.users == 0:
-            bpy.data.textures.remove(block)
-    for block in bpy.data.images:
-        if block.users == 0:
-            bpy.data.images.remove(block)
+    # Clear orphan data, so the imported blocks keep their names rather than
+    # getting .001 suffixes next to leftovers
+    cleanup_orphans()
 
 
 def import_pmx(pmx_path):
@@ -93,9 +86,22 @@ def import_pmx(pmx_path):
     print("Import complete")
 
 
-def find_main_mesh():
+def classify_objects():
+    """Group the scene's objects by type in a single pass.
+
+    Returns a dict of MESH, ARMATURE, EMPTY and OTHER object lists.
+    """
+    objects = {"MESH": [], "ARMATURE": [], "EMPTY": [], "OTHER": []}
+    for obj in bpy.data.objects:
+        objects.get(obj.type, objects["OTHER"]).append(obj)
+    return objects
+
+
+def find_main_mesh(objects=None):
     """Find the main mesh object (the one with the most vertices)."""
-    meshes = [obj for obj in bpy.data.objects if obj.type == "MESH"]
+    if objects is None:
+        objects = classify_objects()
+    meshes = objects["MESH"]
     if not meshes:
         raise ValueError("No mesh objects found")
 
@@ -107,9 +113,11 @@ def find_main_mesh():
     return main_mesh
 
 
-def find_armature():
+def find_armature(objects=None):
     """Find the armature object."""
-    armatures = [obj for obj in bpy.data.objects if obj.type == "ARMATURE"]
+    if objects is None:
+        objects = classify_objects()
+    armatures = objects["ARMATURE"]
     if armatures:
         return armatures[0]
     return None
@@ -124,19 +132,13 @@ def delete_physics_objects(main_mesh):
 
     print(f"Deleting {len(to_delete)} objects (keeping {main_mesh_name})")
 
-    for obj in to_delete:
-        bpy.data.objects.remove(obj, do_unlink=True)
+    bpy.data.batch_remove(ids=to_delete)
 
     # Remove physics collections
     for col_name in ["RigidBodyWorld", "RigidBodyConstraints"]:
         if col_name in bpy.data.collections:
             bpy.data.collections.remove(bpy.data.collections[col_name])
 
-    # Clean up orphan meshes
-    for mesh in bpy.data.meshes:
-        if mesh.users == 0:
-            bpy.data.meshes.remove(mesh)
-
 
 def delete_armature(armature):
     """Delete the armature and unparent the mesh."""
@@ -144,13 +146,12 @@ def delete_armature(armature):
         return
 
     # Find mesh children and unparent them
-    for obj in bpy.data.objects:
-        if obj.parent == armature:
-            obj.parent = None
-            # Clear armature modifier if present
-            for mod in obj.modifiers:
-                if mod.type == "ARMATURE":
-                    obj.modifiers.remove(mod)
+    for obj in armature.children:
+        obj.parent = None
+        # Clear armature modifier if present
+        for mod in obj.modifiers:
+            if mod.type == "ARMATURE":
+                obj.modifiers.remove(mod)
 
     # Delete the armature
     bpy.ops.object.select_all(action="DESELECT")
@@ -159,10 +160,12 @@ def delete_armature(armature):
     print("Deleted armature")
 
 
-def delete_mmd_root():
+def delete_mmd_root(objects=None):
     """Delete the MMD root empty."""
-    for obj in bpy.data.objects:
-        if obj.type == "EMPTY" and "_arm" not in obj.name:
+    if objects is None:
+        objects = classify_objects()
+    for obj in objects["EMPTY"]:
+        if "_arm" not in obj.name:
             # Check if it's the root (has children that are armature/mesh)
             children_types = [c.type for c in obj.children]
             if "ARMATURE" in children_types or "MESH" in children_types:
@@ -188,6 +191,16 @@ def delete_shape_keys(mesh):
     print(f"Deleted {num_keys} shape keys")
 
 
+def vertex_height(mesh):
+    """Height of the mesh's vertices along local Z, before object scale."""
+    if not mesh.data.vertices:
+        return 0.0
+    co = np.empty(len(mesh.data.vertices) * 3, dtype=np.float32)
+    mesh.data.vertices.foreach_get("co", co)
+    z = co[2::3]
+    return float(z.max() - z.min())
+
+
 def scale_to_height(mesh, target_height):
     """Scale mesh to target height."""
     # Get current height (Z dimension)
@@ -195,11 +208,8 @@ def scale_to_height(mesh, target_height):
     mesh.select_set(True)
     bpy.context.view_layer.objects.active = mesh
 
-    # Get bounding box height
-    bbox = mesh.bound_box
-    min_z = min(v[2] for v in bbox)
-    max_z = max(v[2] for v in bbox)
-    current_height = (max_z - min_z) * mesh.scale[2]
+    # Get vertex extent height
+    current_height = vertex_height(mesh) * mesh.scale[2]
 
     if current_height == 0:
         print("Warning: mesh has zero height")
@@ -211,9 +221,8 @@ def scale_to_height(mesh, target_height):
     # Apply scale
     bpy.ops.object.transform_apply(location=False, rotation=False, scale=True)
 
-    # Recalculate to verify
-    bbox = mesh.bound_box
-    new_height = max(v[2] for v in bbox) - min(v[2] for v in bbox)
+    # Recalculate to verify, from the vertices since bound_box may be stale
+    new_height = vertex_height(mesh)
     print(
         f"Scaled from {current_height:.3f}m to {new_height:.3f}m (target: {target_height}m)"
     )
@@ -263,9 +272,10 @@ def create_new_uvs(mesh):
     # Copy original UV data to new layer
     new_uv = mesh.data.uv_layers.new(name="BakedUV")
 
-    # Copy UV coordinates
-    for i, loop in enumerate(mesh.data.loops):
-        new_uv.data[i].uv = original_uv.data[i].uv.copy()
+    # Copy UV coordinates in one buffer rather than per loop
+    uvs = np.empty(len(mesh.data.loops) * 2, dtype=np.float32)
+    original_uv.data.foreach_get("uv", uvs)
+    new_uv.data.foreach_set("uv", uvs)
 
     new_uv.active = True
 
@@ -283,20 +293,35 @@ def create_new_uvs(mesh):
     print("Created new UVs by repacking original UV islands")
 
 
-def try_fix_texture_path(img):
-    """Try to fix texture path with case-insensitive matching and reload."""
-    if img is None or img.has_data:
-        return
+# Lowercase entry name -> real name, per directory scanned by find_case_insensitive
+_dir_cache: dict[str, dict[str, str]] = {}
 
-    filepath = img.filepath
-    if not filepath:
-        return
 
-    import os
+def find_case_insensitive(directory, name):
+    """Return the path of the entry in directory matching name ignoring case.
+
+    Each directory is only scanned once; materials tend to share a texture folder.
+    """
+    entries = _dir_cache.get(directory)
+    if entries is None:
+        entries = {}
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    entries.setdefault(entry.name.lower(), entry.name)
+        except OSError:
+            pass
+        _dir_cache[directory] = entries
+
+    entry = entries.get(name.lower())
+    return os.path.join(directory, entry) if entry else None
 
-    abs_path = bpy.path.abspath(filepath)
 
-    # Try case-insensitive search for the file
+def find_fixed_path(abs_path):
+    """Find the file abs_path refers to, matching names case-insensitively.
+
+    Filesystem only, so it is safe to call from worker threads.
+    """
     fixed_path = None
 
     if os.path.isfile(abs_path):
@@ -310,28 +335,89 @@ def try_fix_texture_path(img):
             parent = os.path.dirname(directory)
             dirname = os.path.basename(directory)
             if os.path.exists(parent):
-                for entry in os.listdir(parent):
-                    if entry.lower() == dirname.lower():
-                        directory = os.path.join(parent, entry)
-                        break
+                directory = find_case_insensitive(parent, dirname) or directory
 
         # Find file with case-insensitive match
         if os.path.isdir(directory):
-            for entry in os.listdir(directory):
-                if entry.lower() == filename.lower():
-                    fixed_path = os.path.join(directory, entry)
-                    break
+            fixed_path = find_case_insensitive(directory, filename)
 
     if fixed_path and os.path.isfile(fixed_path):
-        # Update filepath and reload
-        img.filepath = fixed_path
-        img.source = "FILE"
-        try:
-            img.reload()
-            # Force pixel access to actually load the data (lazy loading)
-            _ = img.pixels[0]
-        except Exception as e:
-            print(f"    Failed to load {fixed_path}: {e}")
+        return fixed_path
+    return None
+
+
+def apply_fixed_path(img, fixed_path):
+    """Point img at fixed_path and load it."""
+    if not fixed_path:
+        return
+
+    # Update filepath and reload
+    img.filepath = fixed_path
+    img.source = "FILE"
+    try:
+        img.reload()
+        # Images load lazily; update() decodes the buffer without copying
+        # every pixel out into Python floats like pixels[0] does
+        if not img.has_data:
+            img.update()
+    except Exception as e:
+        print(f"    Failed to load {fixed_path}: {e}")
+
+
+def unloaded_path(img):
+    """Absolute path of an image that still needs loading, or None."""
+    if img is None or img.has_data or not img.filepath:
+        return None
+    return bpy.path.abspath(img.filepath)
+
+
+def try_fix_texture_path(img):
+    """Try to fix texture path with case-insensitive matching and reload."""
+    abs_path = unloaded_path(img)
+    if abs_path:
+        apply_fixed_path(img, find_fixed_path(abs_path))
+
+
+def fix_texture_paths(materials):
+    """Fix and load every unloaded image texture used by materials.
+
+    The path searches run in a thread pool; Image.reload isn't thread safe,
+    so the images are then loaded one by one.
+    """
+    images = {}
+    for mat in materials:
+        if mat is None or not mat.use_nodes:
+            continue
+        for node in mat.node_tree.nodes:
+            if node.type == "TEX_IMAGE" and node.image:
+                abs_path = unloaded_path(node.image)
+                if abs_path:
+                    images[node.image] = abs_path
+
+    with ThreadPoolExecutor(max_workers=TEXTURE_SEARCH_THREADS) as pool:
+        fixed_paths = pool.map(find_fixed_path, images.values())
+        for img, fixed_path in zip(images, fixed_paths):
+            apply_fixed_path(img, fixed_path)
+
+
+def analyze_material(nodes):
+    """Collect the nodes ensure_material_has_texture looks at in one walk.
+
+    Returns (mmd_base_tex, image texture nodes that have an image, first
+    Principled BSDF, mmd_shader), with None for any that are missing.
+    """
+    mmd_base_tex = mmd_shader = principled = None
+    tex_nodes = []
+    for node in nodes:
+        if node.name == "mmd_base_tex":
+            mmd_base_tex = node
+        elif node.name == "mmd_shader":
+            mmd_shader = node
+        if node.type == "TEX_IMAGE" and node.image:
+            tex_nodes.append(node)
+        elif node.type == "BSDF_PRINCIPLED" and principled is None:
+            principled = node
+    return mmd_base_tex, tex_nodes, principled, mmd_shader
 
 
 def ensure_material_has_texture(mat):
@@ -348,9 +434,9 @@ def ensure_material_has_texture(mat):
     mat.use_nodes = True
     nodes = mat.node_tree.nodes
     links = mat.node_tree.links
+    mmd_base_tex, tex_nodes, principled, mmd_shader = analyze_material(nodes)
 
     # First, check for mmd_tools setup (mmd_base_tex node)
-    mmd_base_tex = nodes.get("mmd_base_tex")
     if mmd_base_tex and mmd_base_tex.type == "TEX_IMAGE":
         img = mmd_base_tex.image
         if img:
@@ -366,33 +452,29 @@ def ensure_material_has_texture(mat):
             print(f"  Material '{mat.name}': texture failed to load: {img.filepath}")
 
     # Check for any TEX_IMAGE node with a valid image
-    for node in nodes:
-        if node.type == "TEX_IMAGE" and node.image:
-            img = node.image
-            # Try to fix path and reload if not loaded
-            if not img.has_data:
-                try_fix_texture_path(img)
-            if img.has_data:
-                return  # Found a valid texture
+    for node in tex_nodes:
+        img = node.image
+        # Try to fix path and reload if not loaded
+        if not img.has_data:
+            try_fix_texture_path(img)
+        if img.has_data:
+            return  # Found a valid texture
 
     # No valid texture found - need to create a fallback
     # Try to get colour from mmd_shader node group or Principled BSDF
     base_color = (0.8, 0.8, 0.8)  # Default grey
 
     # Check mmd_shader for diffuse colour
-    mmd_shader = nodes.get("mmd_shader")
     if mmd_shader and mmd_shader.type == "GROUP":
         diffuse_input = mmd_shader.inputs.get("Diffuse Color")
         if diffuse_input:
             base_color = diffuse_input.default_value[:3]
 
     # Or check Principled BSDF
-    for node in nodes:
-        if node.type == "BSDF_PRINCIPLED":
-            base_color_input = node.inputs.get("Base Color")
-            if base_color_input:
-                base_color = base_color_input.default_value[:3]
-            break
+    if principled:
+        base_color_input = principled.inputs.get("Base Color")
+        if base_color_input:
+            base_color = base_color_input.default_value[:3]
 
     print(
         f"  Material '{mat.name}' has no valid texture, using colour: {base_color[:3]}"
@@ -405,19 +487,15 @@ def ensure_material_has_texture(mat):
     else:
         img = bpy.data.images.new(name=img_name, width=4, height=4)
         # Fill with the base colour
-        pixels = [base_color[0], base_color[1], base_color[2], 1.0] * 16
-        img.pixels = pixels
+        pixel = np.array([*base_color[:3], 1.0], dtype=np.float32)
+        img.pixels.foreach_set(np.tile(pixel, img.size[0] * img.size[1]))
 
     # If mmd_base_tex exists, update it; otherwise create new and connect to shader
     if mmd_base_tex:
         mmd_base_tex.image = img
     else:
         # Find shader to connect to
-        shader_node = None
-        for node in nodes:
-            if node.type == "BSDF_PRINCIPLED":
-                shader_node = node
-                break
+        shader_node = principled
 
         if shader_node:
             base_color_input = shader_node.inputs.get("Base Color")
@@ -431,6 +509,36 @@ def ensure_material_has_texture(mat):
                 links.new(tex_node.outputs["Color"], base_color_input)
 
 
+def enable_gpu_cycles():
+    """Point Cycles at the best available GPU backend, falling back to CPU.
+
+    Returns the device name that was set on the scene.
+    """
+    scene = bpy.context.scene
+    try:
+        cprefs = bpy.context.preferences.addons["cycles"].preferences
+        for device_type in ("OPTIX", "CUDA", "HIP", "METAL", "ONEAPI"):
+            try:
+                cprefs.compute_device_type = device_type
+            except TypeError:
+                # Backend not compiled into this build
+                continue
+            cprefs.get_devices()
+            gpus = [d for d in cprefs.devices if d.type == device_type]
+            if not gpus:
+                continue
+            for device in cprefs.devices:
+                device.use = device.type == device_type
+            scene.cycles.device = "GPU"
+            print(f"Baking on {device_type}: {', '.join(d.name for d in gpus)}")
+            return "GPU"
+    except Exception as e:
+        print(f"GPU setup failed, baking on CPU: {e}")
+
+    scene.cycles.device = "CPU"
+    return "CPU"
+
+
 def bake_textures(mesh, output_path, size=4096):
     """Bake all materials to a single texture."""
     print(f"Baking textures to {output_path}")
@@ -441,18 +549,21 @@ def bake_textures(mesh, output_path, size=4096):
 
     # Ensure all materials have textures (fix pink squares)
     print("Checking materials for missing textures...")
+    fix_texture_paths(mesh.data.materials)
     for mat in mesh.data.materials:
         ensure_material_has_texture(mat)
 
-    # Create new image for baking
+    # Create new image for baking. 8-bit like the PNG it's saved to, a quarter
+    # of the memory of a float buffer
     bake_image = bpy.data.images.new(
-        name="BakedTexture", width=size, height=size, alpha=True
+        name="BakedTexture", width=size, height=size, alpha=True, float_buffer=False
     )
     bake_image.filepath = str(output_path)
 
     # Set up materials to receive the bake
     # We need to add an image texture node to each material pointing to our bake image
-    for mat in mesh.data.materials:
+    # Cycles needs one per material, but only one, however many slots share it
+    for mat in dict.fromkeys(mesh.data.materials):
         if mat is None:
             continue
 
@@ -468,13 +579,18 @@ def bake_textures(mesh, output_path, size=4096):
 
     # Configure bake settings
     bpy.context.scene.render.engine = "CYCLES"
-    bpy.context.scene.cycles.device = "CPU"  # Use CPU for compatibility
+    enable_gpu_cycles()
     bpy.context.scene.cycles.samples = 1
+    # Nothing to denoise or adapt with a single sample
+    bpy.context.scene.cycles.use_denoising = False
+    bpy.context.scene.cycles.use_adaptive_sampling = False
     bpy.context.scene.cycles.bake_type = "DIFFUSE"
     bpy.context.scene.render.bake.use_pass_direct = False
     bpy.context.scene.render.bake.use_pass_indirect = False
     bpy.context.scene.render.bake.use_pass_color = True
-    bpy.context.scene.render.bake.margin = 16
+    bpy.context.scene.render.bake.margin = BAKE_MARGIN
+    # Extend edge pixels rather than building a face adjacency map
+    bpy.context.scene.render.bake.margin_type = "EXTEND"
 
     # Perform bake
     print("Baking... (this may take a while)")
@@ -486,10 +602,7 @@ def bake_textures(mesh, output_path, size=4096):
     bake_image.save()
     print(f"Saved baked texture to {output_path}")
 
-    # Pack image into blend file
-    bake_image.pack()
-    print("Packed image into blend file")
-
+    # main() packs it into the blend file along with everything else
     return bake_image
 
 
@@ -533,18 +646,9 @@ def replace_materials(mesh, bake_image):
 
 def cleanup_orphans():
     """Remove orphan data blocks."""
-    for block in bpy.data.meshes:
-        if block.users == 0:
-            bpy.data.meshes.remove(block)
-    for block in bpy.data.materials:
-        if block.users == 0:
-            bpy.data.materials.remove(block)
-    for block in bpy.data.images:
-        if block.users == 0:
-            bpy.data.images.remove(block)
-    for block in bpy.data.armatures:
-        if block.users == 0:
-            bpy.data.armatures.remove(block)
+    # Recursive, so blocks only used by other orphans (a removed mesh's
+    # materials and their images) go in the same pass
+    bpy.data.orphans_purge(do_local_ids=True, do_linked_ids=False, do_recursive=True)
 
 
 def main():
@@ -572,8 +676,9 @@ def main():
     import_pmx(pmx_path)
 
     # Find main objects
-    main_mesh = find_main_mesh()
-    armature = find_armature()
+    objects = classify_objects()
+    main_mesh = find_main_mesh(objects)
+    armature = find_armature(objects)
 
     # Delete armature first
     print("\nRemoving MMD armature...")